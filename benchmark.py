@@ -0,0 +1,687 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+# MIT 2011
+'''
+Benchmarks for youtube2mediawiki against a local stand-in for YouTube and
+MediaWiki, so that changes can be measured without the real services.
+
+The stand-in serves the watch page stream maps, the gdata feeds of videos,
+playlists and channel uploads, timedtext and the video streams, and emulates the MediaWiki API calls used for login,
+queries, chunked uploads and edits. Latency, bandwidth and error injection
+are configurable.
+
+Each scenario is imported in its own process, so that its peak RSS can be
+measured, and the results are written to a JSON file.
+'''
+import BaseHTTPServer
+import cgi
+import gzip
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib import quote
+from urlparse import urlparse, parse_qs
+from cStringIO import StringIO
+from xml.sax.saxutils import escape
+
+import youtube2mediawiki
+
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+SCENARIOS = {
+    # size of the video and audio streams in MB and number of caption tracks
+    'small': {'video': 2, 'audio': 0, 'captions': 1},
+    'large': {'video': 64, 'audio': 0, 'captions': 1},
+    'dash': {'video': 24, 'audio': 4, 'captions': 1},
+    'captions': {'video': 1, 'audio': 0, 'captions': 40},
+}
+CAPTION_LINES = 500
+
+FEED = u'''<?xml version='1.0' encoding='UTF-8'?>
+<entry xmlns='http://www.w3.org/2005/Atom' xmlns:media='http://search.yahoo.com/mrss/'>
+<published>2011-05-01T12:00:00.000Z</published>
+<title>%(title)s</title>
+<author><name>bench</name><uri>http://gdata.youtube.com/feeds/api/users/bench</uri></author>
+<media:group>
+<media:category label='Education'>Education</media:category>
+<media:description type='plain'>%(description)s</media:description>
+<media:keywords>benchmark, youtube2mediawiki</media:keywords>
+</media:group>
+</entry>
+'''
+
+LIST_FEED = u'''<?xml version='1.0' encoding='UTF-8'?>
+<feed xmlns='http://www.w3.org/2005/Atom' xmlns:media='http://search.yahoo.com/mrss/' xmlns:yt='http://gdata.youtube.com/schemas/2007'>
+<title>%(title)s</title>
+%(next)s%(entries)s</feed>
+'''
+
+LIST_ENTRY = u'''<entry><updated>%(updated)s</updated><title>%(title)s</title><media:group><yt:videoid>%(id)s</yt:videoid></media:group></entry>
+'''
+
+WATCH_PAGE = '''<html><body>
+<script>var ytplayer = {"args": {"url_encoded_fmt_stream_map": "%(stream_map)s", "adaptive_fmts": "%(adaptive_fmts)s"}};</script>
+<h4>License:</h4><p>Creative Commons Attribution license (reuse allowed)</p>
+</body></html>
+'''
+
+class Services(object):
+    '''
+    State of the stand-in YouTube and MediaWiki, shared by all requests.
+
+    latency is added to every request in seconds, bandwidth limits each
+    request and response body in bytes per second. With error_rate, that
+    fraction of video requests is cut off halfway and of upload chunks
+    fails with 503. With lag_rate, that fraction of API requests sent with
+    maxlag fails with a maxlag error. With compress, pages, feeds and API
+    responses are gzip encoded for clients accepting it.
+    '''
+    def __init__(self, latency=0, bandwidth=0, error_rate=0, seed=0, lag_rate=0, compress=True):
+        self.latency = latency
+        self.compress = compress
+        self.max_upload_size = 4 * 1024 * 1024 * 1024
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.lag_rate = lag_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.videos = {}
+        self.playlists = {}
+        self.files = {}
+        self.pages = {}
+        self.stash = {}
+        self.polls = {}
+        self.sessions = set()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {
+                'connections': 0,
+                'requests': {},
+                'bytes_in': 0,
+                'bytes_out': 0,
+                'injected_errors': 0
+            }
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def count_request(self, kind):
+        with self.lock:
+            requests = self.stats['requests']
+            requests[kind] = requests.get(kind, 0) + 1
+
+    def fail(self, rate=None):
+        '''Whether to inject an error into the current request.'''
+        rate = self.error_rate if rate is None else rate
+        with self.lock:
+            failed = rate and self.random.random() < rate
+            if failed:
+                self.stats['injected_errors'] += 1
+            return failed
+
+    def add_video(self, id, title, video, audio=None, captions={}):
+        '''
+        Serve a video with the stream data video and, if given, the DASH
+        audio stream audio. captions maps languages to (start, duration,
+        text) tuples.
+        '''
+        self.videos[id] = {
+            'id': id,
+            'title': title,
+            'description': 'Benchmark video %s' % id,
+            'streams': {'43': video, '248': video, '251': audio},
+            'captions': captions,
+            'updated': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        }
+
+    def add_playlist(self, id, videos):
+        '''Serve the playlist id of the ids videos.'''
+        self.playlists[id] = list(videos)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def services(self):
+        return self.server.services
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.services.count('connections')
+
+    def do_HEAD(self):
+        self.route(False)
+
+    def do_GET(self):
+        self.route(True)
+
+    def do_POST(self):
+        if self.services.latency:
+            time.sleep(self.services.latency)
+        body = self.read_body(int(self.headers.get('Content-Length') or 0))
+        if urlparse(self.path).path != '/w/api.php':
+            return self.respond('', 404, body=True)
+        self.api(body)
+
+    def route(self, body):
+        if self.services.latency:
+            time.sleep(self.services.latency)
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query, True).items())
+        if url.path.startswith('/feeds/api/playlists/'):
+            return self.list_feed(self.services.playlists.get(url.path.split('/')[-1]), query, body)
+        if url.path.startswith('/feeds/api/users/') and url.path.endswith('/uploads'):
+            return self.list_feed(sorted(self.services.videos), query, body)
+        video = self.services.videos.get(query.get('v') or query.get('id'))
+        if url.path.startswith('/feeds/api/videos/'):
+            video = self.services.videos.get(url.path.split('/')[-1])
+        if not video:
+            return self.respond('', 404, body=body)
+        if url.path == '/watch':
+            self.services.count_request('youtube:watch')
+            self.respond(self.watch_page(video), content_type='text/html', body=body)
+        elif url.path.startswith('/feeds/api/videos/'):
+            self.services.count_request('youtube:feed')
+            data = FEED % {
+                'title': escape(video['title']),
+                'description': escape(video['description'])
+            }
+            self.respond(data.encode('utf-8'), content_type='application/atom+xml', body=body)
+        elif url.path == '/api/timedtext':
+            self.services.count_request('youtube:timedtext')
+            self.timedtext(video, query, body)
+        elif url.path == '/videoplayback':
+            self.services.count_request('youtube:videoplayback')
+            self.videoplayback(video['streams'][query['itag']], body)
+        else:
+            self.respond('', 404, body=body)
+
+    def list_feed(self, videos, query, body):
+        '''Respond with the page of the list feed of videos given by query.'''
+        if videos is None:
+            return self.respond('', 404, body=body)
+        self.services.count_request('youtube:list')
+        start = int(query.get('start-index', 1))
+        size = int(query.get('max-results', 25))
+        page = videos[start - 1:start - 1 + size]
+        next = ''
+        if start - 1 + size < len(videos):
+            next = u"<link rel='next' href='http://%s:%d%s?v=2&amp;start-index=%d&amp;max-results=%d'/>\n" % (
+                self.server.server_address + (self.path.split('?')[0], start + size, size))
+        data = LIST_FEED % {
+            'title': 'Benchmark list',
+            'next': next,
+            'entries': u''.join(LIST_ENTRY % {
+                'id': id, 'title': escape(self.services.videos[id]['title']),
+                'updated': self.services.videos[id]['updated']} for id in page)
+        }
+        self.respond(data.encode('utf-8'), content_type='application/atom+xml', body=body)
+
+    def watch_page(self, video):
+        def stream_map(itags, clen=False):
+            streams = []
+            for itag, type in itags:
+                if video['streams'].get(itag) is None:
+                    continue
+                url = 'http://%s:%d/videoplayback?id=%s&itag=%s' % (
+                    self.server.server_address + (video['id'], itag))
+                fields = [
+                    'url=' + quote(url, ''),
+                    'type=' + quote(type, ''),
+                    'itag=' + itag
+                ]
+                # like YouTube, only adaptive streams have their size
+                if clen:
+                    fields.append('clen=%d' % len(video['streams'][itag]))
+                streams.append('\\u0026'.join(fields))
+            return ','.join(streams)
+        return WATCH_PAGE % {
+            'stream_map': stream_map([('43', 'video/webm; codecs="vp8.0, vorbis"')]),
+            'adaptive_fmts': stream_map([('248', 'video/webm; codecs="vp9"'),
+                                         ('251', 'audio/webm; codecs="opus"')], True)
+        }
+
+    def timedtext(self, video, query, body):
+        if query.get('type') == 'list':
+            data = '<?xml version="1.0" encoding="utf-8" ?><transcript_list docid="0">%s</transcript_list>' % ''.join([
+                '<track id="%d" name="" lang_code="%s" lang_original="%s" lang_translated="%s"/>' % (
+                    n, language, language, language)
+                for n, language in enumerate(sorted(video['captions']))
+            ])
+        else:
+            lines = video['captions'].get(query.get('lang'))
+            if lines is None:
+                return self.respond('', 404, body=body)
+            data = '<?xml version="1.0" encoding="utf-8" ?><transcript>%s</transcript>' % ''.join([
+                '<text start="%s" dur="%s">%s</text>' % (start, duration, escape(text))
+                for start, duration, text in lines
+            ])
+        self.respond(data, content_type='text/xml', body=body)
+
+    def videoplayback(self, data, body):
+        start, end = 0, len(data)
+        code = 200
+        range = self.headers.get('Range')
+        if range and range.startswith('bytes='):
+            first, last = range[6:].split('-')
+            start = int(first)
+            end = int(last) + 1 if last else len(data)
+            code = 206
+        self.send_response(code)
+        self.send_header('Content-Type', 'video/webm')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start))
+        if code == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, len(data)))
+        self.end_headers()
+        if not body:
+            return
+        if end - start > 64 * 1024 and self.services.fail():
+            # drop the connection halfway through the response
+            self.write_body(data[start:start + (end - start) // 2])
+            self.close_connection = 1
+            return
+        self.write_body(data[start:end])
+
+    def read_body(self, length):
+        data = []
+        while length > 0:
+            block = self.rfile.read(min(length, 64 * 1024))
+            if not block:
+                break
+            data.append(block)
+            length -= len(block)
+            self.throttle(len(block))
+        data = ''.join(data)
+        self.services.count('bytes_in', len(data))
+        return data
+
+    def write_body(self, data):
+        for offset in xrange(0, len(data), 64 * 1024):
+            block = data[offset:offset + 64 * 1024]
+            self.wfile.write(block)
+            self.throttle(len(block))
+        self.services.count('bytes_out', len(data))
+
+    def throttle(self, length):
+        if self.services.bandwidth:
+            time.sleep(float(length) / self.services.bandwidth)
+
+    def respond(self, data, code=200, content_type='text/plain', headers=[], body=True):
+        if self.services.compress and data and content_type != 'text/plain' and \
+            'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+                f.write(data)
+            data = buf.getvalue()
+            headers = headers + [('Content-Encoding', 'gzip')]
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if body:
+            self.write_body(data)
+
+    def api(self, body):
+        form = cgi.FieldStorage(fp=StringIO(body), headers=self.headers, environ={
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': self.headers.get('Content-Type', '')
+        })
+        params = dict((key, form[key].value) for key in form.keys())
+        action = params.get('action')
+        self.services.count_request('wiki:%s' % action)
+        cookie = self.headers.get('Cookie', '')
+        self.session = cookie.split('session=')[-1].split(';')[0] if 'session=' in cookie else None
+        self.cookies = []
+        if action == 'upload' and 'chunk' in params and self.services.fail():
+            return self.respond('Service Unavailable', 503)
+        if 'maxlag' in params and self.services.fail(self.services.lag_rate):
+            r = self.error('maxlag', 'Waiting for 127.0.0.1: 6 seconds lagged')
+            r['error']['lag'] = 6
+            return self.respond(json.dumps(r), content_type='application/json',
+                                headers=[('Retry-After', '1')])
+        if action != 'login' and params.get('assert') == 'user' and \
+            self.session not in self.services.sessions:
+            r = self.error('assertuserfailed', 'You are not logged in')
+        elif 'token' in params and params['token'] != self.edit_token():
+            r = self.error('badtoken', 'Invalid token')
+        else:
+            method = getattr(self, 'api_%s' % action, None)
+            r = method(params) if method else self.error('unknown_action', action)
+        self.respond(json.dumps(r), content_type='application/json',
+                     headers=[('Set-Cookie', c) for c in self.cookies])
+
+    def error(self, code, info):
+        return {'error': {'code': code, 'info': info}}
+
+    def edit_token(self):
+        return hashlib.md5(self.session or '').hexdigest() + '+\\'
+
+    def api_login(self, params):
+        if 'lgtoken' not in params:
+            return {'login': {'result': 'NeedToken', 'token': 'logintoken', 'sessionid': 'anonymous'}}
+        if (params.get('lgname'), params.get('lgpassword')) != (USERNAME, PASSWORD):
+            return {'login': {'result': 'WrongPass'}}
+        session = os.urandom(8).encode('hex')
+        with self.services.lock:
+            self.services.sessions.add(session)
+        self.cookies.append('session=%s; path=/' % session)
+        return {'login': {'result': 'Success', 'lgusername': USERNAME}}
+
+    def api_query(self, params):
+        services = self.services
+        if params.get('meta') == 'siteinfo':
+            return {'query': {'general': {
+                'sitename': 'Benchmark',
+                'maxuploadsize': services.max_upload_size,
+                'minuploadchunksize': 1024
+            }}}
+        if params.get('list') == 'allimages':
+            return {'query': {'allimages': [
+                {'name': title[5:], 'descriptionurl': self.page_url(title)}
+                for title, data in services.files.items()
+                if hashlib.sha1(data).hexdigest() == params.get('aisha1')
+            ]}}
+        pages = {}
+        normalized = []
+        for n, title in enumerate(params.get('titles', '').split('|')):
+            name = title.replace('_', ' ')
+            if name != title:
+                normalized.append({'from': title, 'to': name})
+            page = {'title': name, 'edittoken': self.edit_token()}
+            if name in services.files or name in services.pages:
+                pages[str(n + 1)] = page
+            else:
+                page['missing'] = ''
+                pages[str(-1 - n)] = page
+        return {'query': {'normalized': normalized, 'pages': pages}}
+
+    def api_upload(self, params):
+        services = self.services
+        if 'checkstatus' in params:
+            with services.lock:
+                return {'upload': services.polls.pop(params.get('filekey'), None) or
+                        {'result': 'Success', 'filekey': params.get('filekey')}}
+        if 'chunk' in params:
+            with services.lock:
+                filekey = params.get('filekey') or os.urandom(8).encode('hex') + '.webm'
+                data = services.stash.get(filekey, '')
+                if int(params['offset']) != len(data):
+                    return self.error('stashfailed', 'Invalid offset %s, expected %d' % (
+                        params['offset'], len(data)))
+                data += params['chunk']
+                services.stash[filekey] = data
+            result = 'Continue'
+            if len(data) >= int(params['filesize']):
+                result = 'Poll' if params.get('async') else 'Success'
+            return {'upload': {'result': result, 'filekey': filekey, 'offset': len(data)}}
+        with services.lock:
+            filekey = params.get('filekey')
+            if filekey not in services.stash:
+                return self.error('missingresult', 'No stashed file %s' % filekey)
+            title = 'File:' + params['filename'].replace('_', ' ')
+            if title in services.files and 'ignorewarnings' not in params:
+                return {'upload': {'result': 'Warning', 'warnings': {'exists': params['filename']}}}
+            data = services.files[title] = services.stash.pop(filekey)
+            result = {
+                'result': 'Success',
+                'filename': params['filename'],
+                'imageinfo': {
+                    'descriptionurl': self.page_url(title),
+                    'sha1': hashlib.sha1(data).hexdigest(),
+                    'size': len(data)
+                }
+            }
+            if params.get('async'):
+                services.polls[filekey] = result
+                return {'upload': {'result': 'Poll', 'stage': 'queued', 'filekey': filekey}}
+        return {'upload': result}
+
+    def api_edit(self, params):
+        title = params['title'].replace('_', ' ')
+        with self.services.lock:
+            if params.get('createonly') and title in self.services.pages:
+                return self.error('articleexists', 'The page you tried to create has been created already.')
+            self.services.pages[title] = params.get('text', '')
+        return {'edit': {'result': 'Success', 'title': title}}
+
+    def page_url(self, title):
+        return 'http://%s:%d/wiki/%s' % (self.server.server_address + (quote(title.replace(' ', '_')), ))
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve(services, port=0):
+    '''Run the stand-in for services in a background thread, returns its base url.'''
+    server = Server(('127.0.0.1', port), Handler)
+    server.services = services
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://%s:%d' % server.server_address
+
+def generate_streams(directory, video_mb, audio_mb):
+    '''
+    Encode test video and audio streams of about the given sizes with
+    ffmpeg, as needed to merge DASH streams. Returns their data.
+    '''
+    ffmpeg = youtube2mediawiki.ffmpeg_installed()
+    seconds = 20
+    video = os.path.join(directory, 'video.webm')
+    audio = os.path.join(directory, 'audio.webm')
+    for args in (
+        ['-f', 'lavfi', '-i', 'testsrc=size=1280x720:rate=25:duration=%d' % seconds, '-an',
+         '-c:v', 'libvpx', '-deadline', 'realtime', '-cpu-used', '8',
+         '-b:v', '%dk' % (video_mb * 8 * 1024 // seconds), video],
+        ['-f', 'lavfi', '-i', 'sine=frequency=440:duration=%d' % seconds, '-vn',
+         '-c:a', 'libvorbis', '-b:a', '%dk' % max(64, audio_mb * 8 * 1024 // seconds), audio]):
+        subprocess.check_call([ffmpeg, '-nostdin', '-y', '-loglevel', 'error'] + args)
+    with open(video, 'rb') as f:
+        video_data = f.read()
+    with open(audio, 'rb') as f:
+        audio_data = f.read()
+    return video_data, audio_data
+
+def add_scenario(services, name, run, directory):
+    '''Add the video for run of scenario name to services, returns its id.'''
+    scenario = SCENARIOS[name]
+    id = '%s%d' % (name, run)
+    if scenario['audio']:
+        video, audio = generate_streams(directory, scenario['video'], scenario['audio'])
+    else:
+        video, audio = os.urandom(scenario['video'] * 1024 * 1024), None
+    languages = ['en', 'de', 'fr', 'es', 'it', 'pt', 'ru', 'ja', 'zh', 'ar']
+    captions = {}
+    for n in range(scenario['captions']):
+        language = languages[n % len(languages)] + ('' if n < len(languages) else '-x%d' % n)
+        captions[language] = [(i * 2.5, 2.0, u'Line %d of %s & more' % (i, language))
+                              for i in range(CAPTION_LINES)]
+    services.add_video(id, 'Benchmark %s %d' % (name, run), video, audio, captions)
+    return id, len(video) + len(audio or '')
+
+class TimedMediawiki(youtube2mediawiki.Mediawiki):
+    '''Mediawiki recording the time spent in chunked uploads.'''
+    upload_seconds = 0
+
+    def upload_chunks(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return youtube2mediawiki.Mediawiki.upload_chunks(self, *args, **kwargs)
+        finally:
+            self.upload_seconds += time.time() - start
+
+def run_import(id, base, opts):
+    '''Import id from the stand-in at base, returns the measurements.'''
+    youtube2mediawiki.YOUTUBE_URL = base
+    youtube2mediawiki.GDATA_URL = base
+    youtube2mediawiki.MERGE_DASH = opts.dash
+    youtube2mediawiki.PIPELINE_UPLOAD = opts.pipeline
+    youtube2mediawiki.STREAM_UPLOAD = opts.stream
+    mediawiki_url = base + '/w/api.php'
+    # progress messages would end up in the result
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        start = time.time()
+        wiki = TimedMediawiki(mediawiki_url, USERNAME, PASSWORD)
+        youtube2mediawiki.import_youtube(id, USERNAME, PASSWORD, mediawiki_url, wiki=wiki)
+        seconds = time.time() - start
+    finally:
+        sys.stdout = stdout
+    return {
+        'seconds': seconds,
+        'upload_seconds': wiki.upload_seconds,
+        'peak_rss_kb': peak_rss_kb()
+    }
+
+def peak_rss_kb():
+    '''
+    Return the peak resident memory of this process in KB. On Linux,
+    ru_maxrss is inherited through exec from the parent holding the
+    stand-in's videos, so VmHWM is read instead.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        peak_rss //= 1024
+    return peak_rss
+
+def run_benchmarks(opts):
+    services = Services(opts.latency / 1000.0, opts.bandwidth * 1024, opts.error_rate, opts.seed,
+                        opts.lag_rate, not opts.no_compression)
+    base = serve(services)
+    directory = tempfile.mkdtemp()
+    results = []
+    print '%-10s %3s %9s %9s %10s %8s %6s' % (
+        'scenario', 'run', 'seconds', 'MB/s', 'rss KB', 'requests', 'conns')
+    for name in opts.scenarios.split(','):
+        for run in range(1, opts.repeat + 1):
+            result = {'scenario': name, 'run': run}
+            try:
+                id, size = add_scenario(services, name, run, directory)
+            except Exception, e:
+                result['skipped'] = str(e)
+                results.append(result)
+                print '%-10s %3d skipped: %s' % (name, run, e)
+                break
+            services.reset_stats()
+            args = [sys.executable, os.path.abspath(__file__), '--run', id, '--server', base]
+            if SCENARIOS[name]['audio']:
+                args.append('--dash')
+            if opts.pipeline:
+                args.append('--pipeline')
+            if opts.stream:
+                args.append('--stream')
+            child = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, errors = child.communicate()
+            if child.returncode != 0:
+                result['error'] = errors.strip().splitlines()[-1] if errors.strip() else 'failed'
+                results.append(result)
+                print '%-10s %3d failed: %s' % (name, run, result['error'])
+                continue
+            result.update(json.loads(output))
+            result['bytes'] = size
+            result['upload_mbps'] = size / result['upload_seconds'] / 1024 / 1024 \
+                if result['upload_seconds'] else None
+            result.update(services.stats)
+            results.append(result)
+            print '%-10s %3d %9.2f %9.2f %10d %8d %6d' % (
+                name, run, result['seconds'], result['upload_mbps'] or 0, result['peak_rss_kb'],
+                sum(result['requests'].values()), result['connections'])
+            # keep the memory of the stand-in small
+            services.videos.pop(id)
+            services.files.clear()
+    shutil.rmtree(directory, True)
+    return {
+        'version': youtube2mediawiki.__version__,
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': {
+            'latency_ms': opts.latency,
+            'bandwidth_kbps': opts.bandwidth,
+            'error_rate': opts.error_rate,
+            'lag_rate': opts.lag_rate,
+            'compression': not opts.no_compression,
+            'pipeline': opts.pipeline,
+            'stream': opts.stream
+        },
+        'results': results
+    }
+
+def compare(old, new):
+    '''Print the change of the best time of each scenario from old to new.'''
+    def best(report):
+        times = {}
+        for result in report['results']:
+            if 'seconds' in result:
+                times[result['scenario']] = min(times.get(result['scenario'], result['seconds']),
+                                                result['seconds'])
+        return times
+    old, new = best(old), best(new)
+    print
+    print '%-10s %9s %9s %8s' % ('scenario', 'before', 'after', 'change')
+    for name in sorted(new):
+        if name in old:
+            print '%-10s %9.2f %9.2f %+7.1f%%' % (
+                name, old[name], new[name], (new[name] - old[name]) / old[name] * 100)
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    usage = "Usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-s', '--scenarios', dest='scenarios', help='comma separated scenarios to run [default:%s]' % ','.join(sorted(SCENARIOS)),
+                      type='string', default='small,large,dash,captions')
+    parser.add_option('-n', '--repeat', dest='repeat', help='number of runs per scenario [default:1]', type='int', default=1)
+    parser.add_option('-o', '--output', dest='output', help='write the results as JSON to FILE [default:benchmark.json]', type='string', default='benchmark.json')
+    parser.add_option('-c', '--compare', dest='compare', help='compare the results with an earlier output FILE', type='string')
+    parser.add_option('--latency', dest='latency', help='latency added to every request in ms [default:0]', type='int', default=0)
+    parser.add_option('--bandwidth', dest='bandwidth', help='bandwidth per request in KB/s, 0 for unlimited [default:0]', type='int', default=0)
+    parser.add_option('--error-rate', dest='error_rate', help='fraction of downloads and upload chunks that fail [default:0]', type='float', default=0)
+    parser.add_option('--lag-rate', dest='lag_rate', help='fraction of API requests that fail with a maxlag error [default:0]', type='float', default=0)
+    parser.add_option('--no-compression', dest='no_compression', help='send all responses of the stand-in without gzip encoding', action="store_true")
+    parser.add_option('--seed', dest='seed', help='seed for the injected errors [default:0]', type='int', default=0)
+    parser.add_option('-P', '--pipeline', dest='pipeline', help='import with --pipeline', action="store_true")
+    parser.add_option('--stream', dest='stream', help='import with --stream', action="store_true")
+    # used for the import in a separate process
+    parser.add_option('--run', dest='run', help='import id from --server and print the measurements', type='string')
+    parser.add_option('--server', dest='server', type='string')
+    parser.add_option('--dash', dest='dash', action="store_true", default=False)
+    (opts, args) = parser.parse_args()
+
+    if opts.run:
+        print json.dumps(run_import(opts.run, opts.server, opts))
+    else:
+        report = run_benchmarks(opts)
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        if opts.compare:
+            with open(opts.compare) as f:
+                compare(json.load(f), report)
@@ -0,0 +1,834 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+# MIT 2011
+'''
+Tests for youtube2mediawiki. The imports run against the local stand-in for
+YouTube and MediaWiki of benchmark.py, the other tests need no server:
+
+    python -m unittest -v test_youtube2mediawiki
+'''
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+import zlib
+from contextlib import closing
+
+import benchmark
+import youtube2mediawiki
+from youtube2mediawiki import BLOCKSIZE, ChunkSizer, Engine, FileHash, ImportIndex, JobStore, \
+    Mediawiki, Metrics, RateLimiter, Return, Slots, Workspace, Youtube, readahead
+
+class ReadaheadTest(unittest.TestCase):
+
+    def test_items(self):
+        self.assertEqual(list(readahead(iter(range(10)), 3)), range(10))
+
+    def test_error(self):
+        def source():
+            yield 1
+            raise ValueError('broken')
+        items = readahead(source())
+        self.assertEqual(next(items), 1)
+        self.assertRaises(ValueError, next, items)
+
+    def test_stop(self):
+        produced = []
+        def source():
+            for i in itertools.count():
+                produced.append(i)
+                yield i
+        items = readahead(source(), 2)
+        self.assertEqual([next(items) for i in range(3)], [0, 1, 2])
+        items.close()
+        # the producer is gone and the source is not read any more
+        count = len(produced)
+        time.sleep(0.1)
+        self.assertEqual(len(produced), count)
+        self.assertTrue(count <= 3 + 2 + 1)
+
+class MultiPartFormTest(unittest.TestCase):
+
+    def form(self):
+        form = youtube2mediawiki.MultiPartForm()
+        form.add_field('filename', u'Tést.webm')
+        data = StringIO.StringIO('x' * 10 + os.urandom(3 * BLOCKSIZE + 1))
+        data.seek(10)
+        form.add_file('chunk', 'Test.webm', data, length=2 * BLOCKSIZE + 1)
+        return form, data.getvalue()[10:10 + 2 * BLOCKSIZE + 1]
+
+    def test_body(self):
+        form, chunk = self.form()
+        body = str(form)
+        self.assertEqual(form.get_content_length(), len(body))
+        self.assertTrue('name="filename"\r\n\r\nT\xc3\xa9st.webm\r\n' in body)
+        self.assertTrue('Content-Type: video/webm\r\n\r\n%s\r\n' % chunk in body)
+        self.assertTrue(body.endswith('--%s--\r\n' % form.boundary))
+
+    def test_read(self):
+        form, chunk = self.form()
+        body = str(form)
+        # file data is read in blocks, never as a whole
+        blocks = list(iter(lambda: form.read(BLOCKSIZE), ''))
+        self.assertEqual(''.join(blocks), body)
+        self.assertTrue(max(len(block) for block in blocks) <= BLOCKSIZE)
+        self.assertEqual(form.read(), '')
+        form.reset()
+        self.assertEqual(form.read(7) + form.read(), body)
+
+    def test_short_file(self):
+        form = youtube2mediawiki.MultiPartForm()
+        form.add_file('chunk', 'data.bin', StringIO.StringIO('x' * 10), length=20)
+        self.assertRaises(Exception, str, form)
+
+class FileHashTest(unittest.TestCase):
+
+    def test_out_of_order(self):
+        data = os.urandom(64 * 1024 + 100)
+        blocks = [(offset, data[offset:offset + 1000]) for offset in range(0, len(data), 1000)]
+        random.shuffle(blocks)
+        f = tempfile.NamedTemporaryFile()
+        f.truncate(len(data))
+        file_hash = FileHash(f.name)
+        lock = threading.Lock()
+        def write(block):
+            with lock:
+                f.seek(block[0])
+                f.write(block[1])
+                f.flush()
+            file_hash.update(*block)
+        youtube2mediawiki.pmap(write, blocks, 4)
+        self.assertEqual(file_hash.hexdigest(), hashlib.sha1(data).hexdigest())
+        f.close()
+
+    def test_unhashed_rest(self):
+        f = tempfile.NamedTemporaryFile()
+        f.write('abcdef')
+        f.flush()
+        file_hash = FileHash(f.name)
+        file_hash.update(0, 'ab')
+        # blocks never reported are read back from the file
+        self.assertEqual(file_hash.hexdigest(), hashlib.sha1('abcdef').hexdigest())
+        f.close()
+
+class DecompressTest(unittest.TestCase):
+    DATA = ''.join('line %d of the body\n' % i for i in range(20000))
+
+    def read(self, body, encoding, amt):
+        response = youtube2mediawiki.DecompressedResponse(StringIO.StringIO(body), encoding)
+        blocks = list(iter(lambda: response.read(amt), ''))
+        self.assertTrue(max(len(block) for block in blocks) <= amt)
+        return ''.join(blocks)
+
+    def test_gzip(self):
+        body = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=body, mode='wb') as f:
+            f.write(self.DATA)
+        self.assertEqual(self.read(body.getvalue(), 'gzip', 1000), self.DATA)
+
+    def test_deflate(self):
+        self.assertEqual(self.read(zlib.compress(self.DATA), 'deflate', 1000), self.DATA)
+        # without the zlib header
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        body = raw.compress(self.DATA) + raw.flush()
+        self.assertEqual(self.read(body, 'deflate', 100000), self.DATA)
+
+    def test_request_headers(self):
+        handler = youtube2mediawiki.DecompressHandler()
+        request = handler.http_request(youtube2mediawiki.urllib2.Request('http://localhost/'))
+        self.assertEqual(request.unredirected_hdrs.get('Accept-encoding'), 'gzip, deflate')
+        # offsets of range requests refer to the unencoded body
+        request = youtube2mediawiki.urllib2.Request('http://localhost/', headers={'Range': 'bytes=10-'})
+        self.assertFalse(handler.http_request(request).has_header('Accept-encoding'))
+
+class ChunkSizerTest(unittest.TestCase):
+
+    def test_clamp(self):
+        self.assertEqual(ChunkSizer(BLOCKSIZE + 1, BLOCKSIZE, 4 * BLOCKSIZE).size, BLOCKSIZE)
+        self.assertEqual(ChunkSizer(1, 2 * BLOCKSIZE, 4 * BLOCKSIZE).size, 2 * BLOCKSIZE)
+        self.assertEqual(ChunkSizer(100 * BLOCKSIZE, BLOCKSIZE, 4 * BLOCKSIZE).size, 4 * BLOCKSIZE)
+
+    def test_fast_upload(self):
+        sizer = ChunkSizer(BLOCKSIZE, BLOCKSIZE, 4 * BLOCKSIZE)
+        sizer.success(BLOCKSIZE, 0.01)
+        # at most doubled
+        self.assertEqual(sizer.size, 2 * BLOCKSIZE)
+        for i in range(3):
+            sizer.success(sizer.size, 0.01)
+        self.assertEqual(sizer.size, 4 * BLOCKSIZE)
+
+    def test_slow_upload(self):
+        sizer = ChunkSizer(8 * BLOCKSIZE, BLOCKSIZE, 64 * BLOCKSIZE)
+        sizer.success(8 * BLOCKSIZE, 4.0 * ChunkSizer.TARGET_SECONDS)
+        self.assertEqual(sizer.size, 2 * BLOCKSIZE)
+
+    def test_failure(self):
+        sizer = ChunkSizer(8 * BLOCKSIZE, BLOCKSIZE, 64 * BLOCKSIZE)
+        sizer.failure()
+        self.assertEqual(sizer.size, 4 * BLOCKSIZE)
+
+    def test_fixed(self):
+        sizer = ChunkSizer(8 * BLOCKSIZE, BLOCKSIZE, 64 * BLOCKSIZE, adaptive=False)
+        sizer.success(8 * BLOCKSIZE, 0.01)
+        sizer.failure()
+        self.assertEqual(sizer.size, 8 * BLOCKSIZE)
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.rate')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def limiter(self, state):
+        with open(self.filename, 'w') as f:
+            f.write(state)
+        return RateLimiter(10, self.filename)
+
+    def test_invalid_state(self):
+        for state in ('', '[]', '{}', '{"rate": "fast"}'):
+            limiter = self.limiter(state)
+            limiter.acquire()
+            with limiter.state() as state:
+                self.assertEqual(state['rate'], 10)
+
+    def test_bounds(self):
+        limiter = self.limiter(json.dumps({'rate': 0, 'tokens': -1e9, 'time': time.time() + 1e9,
+                                           'paused_until': time.time() + 1e9}))
+        with limiter.state() as state:
+            self.assertEqual(state['rate'], RateLimiter.MIN_RATE)
+            self.assertEqual(state['tokens'], 0)
+            self.assertTrue(state['time'] <= time.time())
+            self.assertTrue(state['paused_until'] <= time.time() + RateLimiter.MAX_PAUSE)
+
+    def test_backoff(self):
+        limiter = RateLimiter(10, self.filename)
+        limiter.backoff(0.2)
+        started = time.time()
+        limiter.acquire()
+        self.assertTrue(time.time() - started >= 0.15)
+        with limiter.state() as state:
+            self.assertEqual(state['rate'], 5)
+
+    def test_private_directory(self):
+        path = youtube2mediawiki.private_directory(self.directory, 'private')
+        self.assertEqual(os.stat(path).st_mode & 0777, 0700)
+        os.chmod(path, 0777)
+        self.assertEqual(youtube2mediawiki.private_directory(self.directory, 'private'), None)
+
+class WorkspaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.workspace = Workspace([self.directory], 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def write(self, space, name, size):
+        filename = os.path.join(space.path, name)
+        with open(filename, 'wb') as f:
+            f.write('x' * size)
+        return filename
+
+    def test_budget(self):
+        space = self.workspace.reserve(60)
+        self.assertEqual(self.workspace.reserve(60, block=False), None)
+        changed = self.workspace.changed()
+        self.assertFalse(changed.done())
+        space.close()
+        self.assertTrue(changed.done())
+        self.assertFalse(os.path.exists(space.path))
+        self.assertNotEqual(self.workspace.reserve(60, block=False), None)
+
+    def test_too_large(self):
+        self.assertRaises(Exception, self.workspace.reserve, 200)
+
+    def test_written(self):
+        space = self.workspace.reserve(10)
+        filename = self.write(space, 'video.webm', 50)
+        space.written(filename)
+        # the files count once they outgrow the reservation
+        self.assertEqual(self.workspace.reserve(60, block=False), None)
+        space.discard(filename)
+        self.assertEqual(space.used, 0)
+        self.assertNotEqual(self.workspace.reserve(60, block=False), None)
+
+    def test_resume(self):
+        space = self.workspace.reserve(10)
+        self.write(space, 'video.dat', 30)
+        space.close(False)
+        self.assertEqual(self.workspace.reserve(10, space.path).used, 30)
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = Engine(4)
+
+    def test_submit(self):
+        self.assertEqual(self.engine.submit(lambda a, b: a + b, 1, b=2).result(), 3)
+
+    def test_coroutine(self):
+        def double(x):
+            return 2 * x
+        def coroutine():
+            a, b = yield [self.engine.submit(double, 1), self.engine.submit(double, 2)]
+            c = yield self.engine.wrap(self).double(a + b)
+            raise Return(c)
+        self.double = double
+        self.assertEqual(self.engine.run(coroutine()), 12)
+
+    def test_error(self):
+        def fail():
+            raise ValueError('broken')
+        def caught():
+            try:
+                yield self.engine.submit(fail)
+            except ValueError:
+                raise Return('caught')
+        def uncaught():
+            yield self.engine.submit(fail)
+        self.assertEqual(self.engine.run(caught()), 'caught')
+        self.assertRaises(ValueError, self.engine.run, uncaught())
+
+    def test_slots(self):
+        slots = Slots(2)
+        lock = threading.Lock()
+        running = [0, 0]
+        def work():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+        def coroutine():
+            yield slots.acquire()
+            try:
+                yield self.engine.submit(work)
+            finally:
+                slots.release()
+        futures = [self.engine.spawn(coroutine()) for i in range(6)]
+        self.engine.gather(futures).result()
+        self.assertEqual(running[1], 2)
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory, True)
+
+    def test_jobs(self):
+        metrics = Metrics()
+        filename = os.path.join(self.directory, 'metrics.json')
+        metrics.open(filename)
+        with metrics.job('outer'):
+            with metrics.job('inner'):
+                metrics.event('a')
+            metrics.event('b')
+            thread = threading.Thread(target=metrics.bind(lambda: metrics.event('c')))
+            thread.start()
+            thread.join()
+        metrics.close()
+        events = [json.loads(line) for line in open(filename)]
+        self.assertEqual([(e['event'], e['job']) for e in events],
+                         [('a', 'inner'), ('b', 'outer'), ('c', 'outer'), ('summary', None)])
+
+    def test_concurrent_writes(self):
+        metrics = Metrics()
+        filename = os.path.join(self.directory, 'metrics.prom')
+        metrics.open(filename, 'prometheus')
+        def write():
+            for i in range(50):
+                metrics.count('imports', status='ok')
+                metrics.write()
+        threads = [threading.Thread(target=write) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics.write()
+        self.assertTrue('youtube2mediawiki_imports_total{status="ok"} 400\n' in open(filename).read())
+        self.assertEqual(os.listdir(self.directory), ['metrics.prom'])
+
+    def test_failed_export(self):
+        metrics = Metrics()
+        metrics.open(os.path.join(self.directory, 'missing', 'metrics.prom'), 'prometheus')
+        metrics.count('imports', status='ok')
+        metrics.write()
+        self.assertTrue('can not write metrics' in sys.stdout.getvalue())
+
+class StandInTest(unittest.TestCase):
+    '''Imports from a fresh stand-in, with the globals of youtube2mediawiki restored afterwards.'''
+    GLOBALS = ['YOUTUBE_URL', 'GDATA_URL', 'JOB_STORE', 'INDEX', 'IO_THREADS', 'WORKSPACE',
+               'CHUNKSIZE', 'MIN_CHUNKSIZE', 'ADAPTIVE_CHUNKS', 'RATE_LIMIT_DIR', 'PIPELINE_UPLOAD',
+               'OVERWRITE', 'MERGE_DASH', 'STREAM_MERGE', 'DEDUPE', 'SESSION_CACHE', 'IGNORE_WARNINGS']
+
+    def setUp(self):
+        self.saved = dict((name, getattr(youtube2mediawiki, name)) for name in self.GLOBALS)
+        self.services = benchmark.Services()
+        youtube2mediawiki.YOUTUBE_URL = youtube2mediawiki.GDATA_URL = benchmark.serve(self.services)
+        self.api = youtube2mediawiki.YOUTUBE_URL + '/w/api.php'
+        self.directory = tempfile.mkdtemp()
+        youtube2mediawiki.WORKSPACE = Workspace([self.directory])
+        # no rate limit state shared with other importers
+        youtube2mediawiki.RATE_LIMIT_DIR = None
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        for name, value in self.saved.items():
+            setattr(youtube2mediawiki, name, value)
+        shutil.rmtree(self.directory, True)
+
+    def add_video(self, id, languages=('en', 'de'), audio=False):
+        captions = dict((lang, [(0, 2.0, u'Caption in %s' % lang)]) for lang in languages)
+        self.services.add_video(id, 'Test %s' % id, os.urandom(256 * 1024),
+                                os.urandom(64 * 1024) if audio else None, captions)
+        return id
+
+    def ffmpeg(self):
+        '''
+        A stand-in for ffmpeg, "merging" by appending the audio to the video.
+        It fails while there is a file named like it with .fail appended.
+        '''
+        ffmpeg = os.path.join(self.directory, 'ffmpeg')
+        with open(ffmpeg, 'w') as f:
+            f.write('#!/bin/sh\n[ "$1" = -version ] && exit\n[ -e "$0.fail" ] && exit 1\n'
+                    'cat "$4" "$6" > "${11}"\n')
+        os.chmod(ffmpeg, 0755)
+        return ffmpeg
+
+    def requests(self, service):
+        return dict((kind, n) for kind, n in self.services.stats['requests'].items()
+                    if kind.startswith(service + ':'))
+
+    def batch(self, ids):
+        results = StringIO.StringIO()
+        youtube2mediawiki.import_batch(ids, benchmark.USERNAME, benchmark.PASSWORD, self.api, results, jobs=2)
+        outcomes = [json.loads(line) for line in results.getvalue().splitlines()]
+        return dict((outcome['id'], outcome) for outcome in outcomes)
+
+class ImportTest(StandInTest):
+
+    def test_import(self):
+        id = self.add_video('video1')
+        url = youtube2mediawiki.import_youtube(id, benchmark.USERNAME, benchmark.PASSWORD, self.api)
+        self.assertTrue(url.endswith('File%3ATest_video1.webm'))
+        self.assertTrue('TimedText:Test video1.webm.de.srt' in self.services.pages)
+
+    def test_batch_async(self):
+        youtube2mediawiki.IO_THREADS = 4
+        ids = [self.add_video('video%d' % i) for i in range(3)]
+        outcomes = self.batch(ids)
+        self.assertEqual(sorted(outcomes), ids)
+        self.assertEqual(set(outcome['status'] for outcome in outcomes.values()), set(['ok']))
+        self.assertEqual(youtube2mediawiki.WORKSPACE.reservations, [])
+
+    def test_batch_forgets_videos(self):
+        youtube2mediawiki.OVERWRITE = True
+        ids = [self.add_video('video%d' % i) for i in range(3)]
+        for threads in (None, 4):
+            youtube2mediawiki.IO_THREADS = threads
+            yt = Youtube()
+            results = StringIO.StringIO()
+            youtube2mediawiki.import_batch(ids, benchmark.USERNAME, benchmark.PASSWORD, self.api,
+                                           results, jobs=2, yt=yt)
+            self.assertEqual(len(results.getvalue().splitlines()), 3)
+            # nothing is kept of the imported videos
+            self.assertEqual(yt.pages, {})
+            self.assertEqual(yt.preloaded, {})
+
+    def test_dedupe(self):
+        id = self.add_video('video1')
+        youtube2mediawiki.import_youtube(id, benchmark.USERNAME, benchmark.PASSWORD, self.api)
+        self.services.add_video('copy', 'Test copy', self.services.videos[id]['streams']['43'], None,
+                                {'fr': [(0, 2.0, u'Caption in fr')]})
+        self.services.reset_stats()
+        url = youtube2mediawiki.import_youtube('copy', benchmark.USERNAME, benchmark.PASSWORD, self.api)
+        # the subtitles are added to the file already on the wiki
+        self.assertTrue(url.endswith('File%3ATest_video1.webm'))
+        self.assertFalse('File:Test copy.webm' in self.services.files)
+        self.assertFalse('wiki:upload' in self.requests('wiki'))
+        self.assertTrue('TimedText:Test video1.webm.fr.srt' in self.services.pages)
+
+    def test_job_store_resume(self):
+        youtube2mediawiki.JOB_STORE = os.path.join(self.directory, 'jobs.db')
+        id = self.add_video('video1')
+        class Interrupted(Mediawiki):
+            def upload(self, *args, **kwargs):
+                raise IOError('interrupted')
+        wiki = Interrupted(self.api, benchmark.USERNAME, benchmark.PASSWORD)
+        self.assertRaises(IOError, youtube2mediawiki.import_youtube, id, None, None, self.api, '', wiki, Youtube())
+        store = JobStore(youtube2mediawiki.JOB_STORE)
+        job = store.get(id, self.api)
+        self.assertEqual(job['phase'], 'downloaded')
+        self.assertTrue(os.path.exists(job['workdir']))
+
+        self.services.reset_stats()
+        url = youtube2mediawiki.import_youtube(id, benchmark.USERNAME, benchmark.PASSWORD, self.api)
+        self.assertTrue(url.endswith('File%3ATest_video1.webm'))
+        # the video is not downloaded again
+        self.assertTrue(self.services.stats['bytes_out'] < 256 * 1024)
+        self.assertEqual(store.get(id, self.api)['phase'], 'done')
+        self.assertFalse(os.path.exists(job['workdir']))
+        store.close()
+
+    def test_dash_resume(self):
+        youtube2mediawiki.JOB_STORE = os.path.join(self.directory, 'jobs.db')
+        youtube2mediawiki.MERGE_DASH = True
+        youtube2mediawiki.STREAM_MERGE = False
+        ffmpeg = self.ffmpeg()
+        os.environ['PATH'], path = os.path.dirname(ffmpeg) + os.pathsep + os.environ['PATH'], os.environ['PATH']
+        try:
+            id = self.add_video('video1', audio=True)
+            open(ffmpeg + '.fail', 'w').close()
+            self.assertRaises(Exception, youtube2mediawiki.import_youtube, id,
+                              benchmark.USERNAME, benchmark.PASSWORD, self.api)
+            os.unlink(ffmpeg + '.fail')
+            with closing(JobStore(youtube2mediawiki.JOB_STORE)) as store:
+                self.assertEqual(store.get(id, self.api)['phase'], 'downloaded')
+            reserved = []
+            class Recording(Workspace):
+                def reserve(self, size, path=None, block=True):
+                    reserved.append(size)
+                    return Workspace.reserve(self, size, path, block)
+            youtube2mediawiki.WORKSPACE = Recording([self.directory])
+            # merged from the downloaded streams, not while downloading
+            youtube2mediawiki.STREAM_MERGE = True
+            self.services.reset_stats()
+            url = youtube2mediawiki.import_youtube(id, benchmark.USERNAME, benchmark.PASSWORD, self.api)
+        finally:
+            os.environ['PATH'] = path
+        self.assertEqual(self.services.files['File:Test video1.webm'], ''.join(
+            self.services.videos[id]['streams'][itag] for itag in ('248', '251')))
+        self.assertEqual(reserved, [2 * (256 + 64) * 1024])
+        self.assertFalse('youtube:videoplayback' in self.requests('youtube'))
+
+class ConnectionTest(StandInTest):
+
+    def test_compressed_response(self):
+        id = self.add_video('video1')
+        u = youtube2mediawiki.build_opener().open('%s/watch?v=%s' % (youtube2mediawiki.YOUTUBE_URL, id))
+        self.assertEqual(u.info()['Content-Encoding'], 'gzip')
+        self.assertTrue('url_encoded_fmt_stream_map' in u.read())
+        u.close()
+
+    def test_failed_body(self):
+        form = youtube2mediawiki.MultiPartForm()
+        form.add_file('chunk', 'data.bin', StringIO.StringIO('x' * 10), length=4 * BLOCKSIZE)
+        request = youtube2mediawiki.urllib2.Request(self.api)
+        request.add_header('Content-type', form.get_content_type())
+        request.add_header('Content-length', str(form.get_content_length()))
+        request.add_data(form)
+        opener = youtube2mediawiki.build_opener()
+        self.assertRaises(Exception, opener.open, request)
+        # the half written connection is not kept
+        key = ('http', self.api.split('/')[2], None)
+        self.assertEqual(youtube2mediawiki.CONNECTION_POOL.active[key], 0)
+        self.assertEqual(youtube2mediawiki.CONNECTION_POOL.idle.get(key, []), [])
+
+class YoutubeTest(StandInTest):
+
+    def test_select_streams(self):
+        youtube2mediawiki.MERGE_DASH = True
+        yt = Youtube()
+        def streams(*sizes):
+            return dict((itag, {'itag': itag, 'clen': str(size)}) for itag, size in sizes)
+        videos = streams(('248', 300), ('244', 200), ('242', 100))
+        audios = streams(('251', 50), ('171', 20))
+        pick = lambda max_size: [stream['itag'] for stream in yt.select_streams(videos, audios, max_size)]
+        self.assertEqual(pick(None), ['248', '251'])
+        self.assertEqual(pick(350), ['248', '251'])
+        # better video goes before better audio
+        self.assertEqual(pick(349), ['248', '171'])
+        self.assertEqual(pick(250), ['244', '251'])
+        self.assertEqual(pick(120), ['242', '171'])
+        self.assertRaises(youtube2mediawiki.PermanentError, pick, 119)
+        self.assertRaises(youtube2mediawiki.PermanentError, yt.select_streams, videos, {})
+        youtube2mediawiki.MERGE_DASH = False
+        legacy = streams(('43', 300), ('46', 500))
+        self.assertEqual([s and s['itag'] for s in yt.select_streams(legacy, {}, 400)], ['43', None])
+
+    def test_one_head_per_stream(self):
+        heads = []
+        class Counting(Youtube):
+            def head(self, url):
+                heads.append(url)
+                return Youtube.head(self, url)
+        yt = Counting()
+        id = self.add_video('video1')
+        # the legacy stream map has no sizes, the size check asks the server
+        self.assertEqual(yt.download_size(id, 1024 * 1024), 256 * 1024)
+        filename = os.path.join(self.directory, 'video.webm')
+        yt.download(id, filename, max_size=1024 * 1024)
+        self.assertEqual(os.path.getsize(filename), 256 * 1024)
+        self.assertEqual(len(heads), 1)
+
+    def test_download_video_dedupe(self):
+        youtube2mediawiki.MERGE_DASH = True
+        youtube2mediawiki.STREAM_MERGE = False
+        id = self.add_video('video1', audio=True)
+        filename = os.path.join(self.directory, 'video.webm')
+        video = self.services.videos[id]['streams']
+        sha1 = youtube2mediawiki.download_video(Youtube(), id, filename, self.ffmpeg())
+        self.assertEqual(sha1, hashlib.sha1(video['248'] + video['251']).hexdigest())
+        # the merged file is not read again without deduplication
+        youtube2mediawiki.DEDUPE = False
+        self.assertFalse(youtube2mediawiki.download_video(Youtube(), id, filename, self.ffmpeg()))
+        self.assertEqual(os.path.getsize(filename), (256 + 64) * 1024)
+
+class FanoutTest(StandInTest):
+
+    def test_fanout(self):
+        other = benchmark.Services()
+        wikis = [Mediawiki(api, benchmark.USERNAME, benchmark.PASSWORD)
+                 for api in (self.api, benchmark.serve(other) + '/w/api.php')]
+        id = self.add_video('video1')
+        other.files['File:Test video1.webm'] = 'other'
+        self.services.reset_stats()
+        results = youtube2mediawiki.import_fanout(id, wikis)
+        self.assertEqual([result['wiki'] for result in results], [wiki.url for wiki in wikis])
+        self.assertEqual(results[0]['status'], 'ok')
+        self.assertEqual(self.services.files['File:Test video1.webm'],
+                         self.services.videos[id]['streams']['43'])
+        self.assertTrue('TimedText:Test video1.webm.de.srt' in self.services.pages)
+        # the file on the other wiki is kept
+        self.assertEqual(results[1]['status'], 'error')
+        self.assertEqual(other.files['File:Test video1.webm'], 'other')
+
+    def test_download_once(self):
+        others = [benchmark.Services() for i in range(2)]
+        wikis = [Mediawiki(api, benchmark.USERNAME, benchmark.PASSWORD)
+                 for api in [self.api] + [benchmark.serve(other) + '/w/api.php' for other in others]]
+        id = self.add_video('video1')
+        self.services.reset_stats()
+        results = youtube2mediawiki.import_fanout(id, wikis)
+        self.assertEqual([result['status'] for result in results], ['ok'] * 3)
+        for services in [self.services] + others:
+            self.assertEqual(services.files['File:Test video1.webm'],
+                             self.services.videos[id]['streams']['43'])
+        self.assertEqual(self.requests('youtube')['youtube:watch'], 1)
+        self.assertTrue(self.services.stats['bytes_out'] < 2 * 256 * 1024)
+
+class MediawikiTest(StandInTest):
+
+    def upload_file(self, wiki, name, size):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(size))
+        url = wiki.upload(filename, 'comment', 'text', name)
+        self.assertEqual(self.services.files['File:' + name], open(filename, 'rb').read())
+        return url
+
+    def test_pages_exist(self):
+        wiki = Mediawiki(self.api, benchmark.USERNAME, benchmark.PASSWORD)
+        self.services.pages['Page 7'] = 'text'
+        titles = ['Page_%d' % i for i in range(120)]
+        self.services.reset_stats()
+        exists = wiki.pages_exist(titles)
+        # normalized titles are reported as asked for, 50 titles per query
+        self.assertEqual([title for title in titles if exists[title]], ['Page_7'])
+        self.assertEqual(self.requests('wiki')['wiki:query'], 3)
+        self.assertEqual(wiki.tokens['edit'], wiki.edit_token())
+
+    def test_edit_pages(self):
+        wiki = Mediawiki(self.api, benchmark.USERNAME, benchmark.PASSWORD)
+        pages = [('Page %d' % i, 'text %d' % i) for i in range(10)]
+        self.services.reset_stats()
+        wiki.edit_pages(pages, 'comment')
+        self.assertEqual(dict((title, self.services.pages[title]) for title, text in pages), dict(pages))
+        # one token for all edits
+        self.assertEqual(self.requests('wiki'), {'wiki:query': 1, 'wiki:edit': 10})
+
+    def test_session_cache(self):
+        youtube2mediawiki.SESSION_CACHE = os.path.join(self.directory, 'sessions')
+        token = Mediawiki(self.api, benchmark.USERNAME, benchmark.PASSWORD).edit_token()
+        for name in os.listdir(youtube2mediawiki.SESSION_CACHE):
+            mode = os.stat(os.path.join(youtube2mediawiki.SESSION_CACHE, name)).st_mode
+            self.assertEqual(mode & 0777, 0600)
+        self.services.reset_stats()
+        # a later run reuses the session and its tokens
+        wiki = Mediawiki(self.api, benchmark.USERNAME, benchmark.PASSWORD)
+        self.assertEqual(wiki.edit_token(), token)
+        self.upload_file(wiki, 'Cached.webm', BLOCKSIZE)
+        self.assertFalse('wiki:login' in self.requests('wiki'))
+        # and logs in again once the cached session expired
+        self.services.sessions.clear()
+        self.services.reset_stats()
+        wiki = Mediawiki(self.api, benchmark.USERNAME, benchmark.PASSWORD)
+        self.upload_file(wiki, 'Expired.webm', BLOCKSIZE)
+        self.assertEqual(self.requests('wiki')['wiki:login'], 2)
+        self.assertNotEqual(wiki.edit_token(), token)
+
+    def test_session_expires_during_upload(self):
+        youtube2mediawiki.CHUNKSIZE = youtube2mediawiki.MIN_CHUNKSIZE = BLOCKSIZE
+        youtube2mediawiki.ADAPTIVE_CHUNKS = False
+        services = self.services
+        class Expiring(Mediawiki):
+            chunks = 0
+            def api(self, action, data={}, files={}):
+                if 'chunk' in files:
+                    self.chunks += 1
+                    if self.chunks == 3:
+                        services.sessions.clear()
+                return Mediawiki.api(self, action, data, files)
+        wiki = Expiring(self.api, benchmark.USERNAME, benchmark.PASSWORD)
+        self.services.reset_stats()
+        self.upload_file(wiki, 'Expiring.webm', 8 * BLOCKSIZE)
+        # logged in again once, and every chunk is sent once more at most
+        self.assertEqual(self.requests('wiki')['wiki:login'], 2)
+        self.assertEqual(self.requests('wiki')['wiki:upload'], 8 + 1 + 1)
+
+    def test_lost_chunk_response(self):
+        youtube2mediawiki.CHUNKSIZE = youtube2mediawiki.MIN_CHUNKSIZE = BLOCKSIZE
+        youtube2mediawiki.ADAPTIVE_CHUNKS = False
+        class Lossy(Mediawiki):
+            chunks = 0
+            def api(self, action, data={}, files={}):
+                r = Mediawiki.api(self, action, data, files)
+                if 'chunk' in files:
+                    self.chunks += 1
+                    if self.chunks == 3:
+                        raise IOError('connection reset')
+                return r
+        wiki = Lossy(self.api, benchmark.USERNAME, benchmark.PASSWORD)
+        self.services.reset_stats()
+        # the stored chunk is not sent again at a later offset
+        self.upload_file(wiki, 'Lossy.webm', 4 * BLOCKSIZE)
+        self.assertEqual(self.requests('wiki')['wiki:upload'], 4 + 1 + 1)
+
+    def test_pipelined_upload(self):
+        youtube2mediawiki.CHUNKSIZE = youtube2mediawiki.MIN_CHUNKSIZE = BLOCKSIZE
+        youtube2mediawiki.ADAPTIVE_CHUNKS = False
+        youtube2mediawiki.PIPELINE_UPLOAD = True
+        sent = []
+        class Recording(Mediawiki):
+            def api(self, action, data={}, files={}):
+                if 'chunk' in files:
+                    sent.append(files['chunk'][0])
+                return Mediawiki.api(self, action, data, files)
+        wiki = Recording(self.api, benchmark.USERNAME, benchmark.PASSWORD)
+        self.upload_file(wiki, 'Pipelined.webm', 5 * BLOCKSIZE + 1)
+        # chunks read ahead are sent as slices of the file, not copies
+        self.assertEqual(len(sent), 6)
+        self.assertTrue(all(isinstance(chunk, file) for chunk in sent))
+
+class DaemonTest(StandInTest):
+
+    def setUp(self):
+        StandInTest.setUp(self)
+        self.server = youtube2mediawiki.DaemonServer(('127.0.0.1', 0), youtube2mediawiki.DaemonHandler)
+        self.server.importer = youtube2mediawiki.ImportDaemon(benchmark.USERNAME, benchmark.PASSWORD,
+                                                              self.api, 2)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://%s:%d/jobs' % self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        StandInTest.tearDown(self)
+
+    def call(self, path='', data=None):
+        try:
+            u = urllib2.urlopen(self.url + path, data and json.dumps(data))
+        except urllib2.HTTPError, e:
+            u = e
+        try:
+            return u.code, json.load(u)
+        finally:
+            u.close()
+
+    def wait(self, job):
+        for i in range(100):
+            code, status = self.call('/' + job)
+            if status['status'] not in ('queued', 'running'):
+                return status
+            time.sleep(0.1)
+        self.fail('job %s did not finish' % job)
+
+    def test_jobs(self):
+        id = self.add_video('video1')
+        code, job = self.call(data={'id': '%s/watch?v=%s' % (youtube2mediawiki.YOUTUBE_URL, id)})
+        self.assertEqual(code, 202)
+        self.assertEqual((job['id'], job['status']), (id, 'queued'))
+        self.assertEqual(job['options'], {'overwrite': False, 'dash': False})
+        status = self.wait(job['job'])
+        self.assertEqual(status['status'], 'done')
+        self.assertTrue(status['url'].endswith('File%3ATest_video1.webm'))
+        # the file exists now, an import without overwrite fails
+        code, job = self.call(data={'id': id})
+        status = self.wait(job['job'])
+        self.assertEqual(status['status'], 'error')
+        self.assertTrue('exists' in status['error'])
+        self.assertEqual([job['status'] for job in self.call()[1]], ['done', 'error'])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.call(data={'name': 'no id'})[0], 400)
+        self.assertEqual(self.call('/7')[0], 404)
+
+class ImportIndexTest(StandInTest):
+    FEED = '/feeds/api/users/test/uploads'
+
+    def setUp(self):
+        StandInTest.setUp(self)
+        youtube2mediawiki.INDEX = os.path.join(self.directory, 'index.db')
+
+    def sync(self):
+        self.services.reset_stats()
+        results = StringIO.StringIO()
+        youtube2mediawiki.sync(self.FEED, benchmark.USERNAME, benchmark.PASSWORD, self.api, results)
+        outcomes = [json.loads(line) for line in results.getvalue().splitlines()]
+        return dict((outcome['id'], outcome) for outcome in outcomes)
+
+    def test_batch_skips_indexed(self):
+        ids = [self.add_video('video%d' % i) for i in range(2)]
+        urls = dict((id, outcome['url']) for id, outcome in self.batch(ids).items())
+        self.services.reset_stats()
+        outcomes = self.batch(ids)
+        self.assertEqual(dict((id, outcome['url']) for id, outcome in outcomes.items()), urls)
+        self.assertEqual(self.requests('youtube'), {})
+        self.assertEqual(self.requests('wiki').keys(), ['wiki:login'])
+
+    def test_sync(self):
+        ids = [self.add_video('video%d' % i) for i in range(2)]
+        self.assertEqual(sorted(self.sync()), ids)
+        # nothing changed, only the listing is fetched
+        self.assertEqual(self.sync(), {})
+        self.assertEqual(self.requests('wiki'), {})
+        self.assertEqual(self.requests('youtube').keys(), ['youtube:list'])
+
+        video = self.services.videos['video0']
+        video['captions']['fr'] = video['captions']['en']
+        video['updated'] = '2030-01-01T00:00:00.000Z'
+        self.add_video('video2')
+        outcomes = self.sync()
+        self.assertEqual(sorted(outcomes), ['video0', 'video2'])
+        self.assertEqual(outcomes['video0']['captions'], ['fr'])
+        self.assertTrue('TimedText:Test video0.webm.fr.srt' in self.services.pages)
+        index = ImportIndex(youtube2mediawiki.INDEX)
+        self.assertEqual(index.get('video0', self.api)['languages'], ['de', 'en', 'fr'])
+        self.assertEqual(index.get('video0', self.api)['updated'], video['updated'])
+        index.close()
+
+if __name__ == '__main__':
+    unittest.main()
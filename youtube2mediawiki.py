@@ -2,32 +2,86 @@
 # -*- coding: utf-8 -*-
 # vi:si:et:sw=4:sts=4:ts=4
 # MIT 2011
+from contextlib import closing, contextmanager
+import BaseHTTPServer
+import collections
 import cookielib
+import errno
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
 from htmlentitydefs import name2codepoint
-import itertools
+import hashlib
+import httplib
 import json
 import mimetools
 import mimetypes
 import os
 import platform
+import Queue
 import re
+import select
 import shutil
+import socket
+import SocketServer
+import sqlite3
+import stat
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 import traceback
 import urllib2
-from urllib import unquote_plus
+from urllib import addinfourl, unquote_plus
+from urlparse import urlparse, parse_qs
+from cStringIO import StringIO
 import webbrowser
-from xml.dom.minidom import parseString
-from StringIO import StringIO
+import zlib
+from xml.etree.cElementTree import iterparse
 
 
 __version__ = '0.4.1'
 
+ADAPTIVE_CHUNKS=True
+API_RATE=50
+BLOCKSIZE=64*1024
+CACHE_DIR=None
+CACHE_TTL=3600
+CHUNKSIZE=5*1024*1024
 DEBUG=False
+DEDUPE=True
+DOWNLOAD_BLOCKSIZE=1024*1024
+DOWNLOAD_RETRIES=5
+DOWNLOAD_SEGMENTS=4
+EDIT_THREADS=4
+FEED_PAGE_SIZE=50
+GDATA_URL='http://gdata.youtube.com'
 IGNORE_WARNINGS=False
+INDEX=None
+IO_THREADS=None
+JOB_STORE=None
+MAX_CHUNKSIZE=100*1024*1024
+MAX_CONNECTIONS=8
+MAX_DOWNLOADS=2
+MAX_SIZE=None
+MAX_UPLOADS=2
+MAXLAG=5
 MERGE_DASH=False
+MIN_CHUNKSIZE=1024*1024
 OVERWRITE=False
+PIPELINE_UPLOAD=False
+PREFETCH=8
+RATE_LIMIT_DIR=tempfile.gettempdir()
+SESSION_CACHE=None
+STREAM_MERGE=hasattr(os, 'mkfifo')
+STREAM_UPLOAD=False
+SUBTITLE_THREADS=8
+THROTTLE_RETRIES=10
+UPLOAD_READAHEAD=2
+UPLOAD_RETRIES=5
+YOUTUBE_URL='http://www.youtube.com'
 USER_AGENT='youtube2mediawiki/%s (+http://www.mediawiki.org/wiki/User:BotInc/youtube2mediawiki)' % __version__
 YOUTUBE_USER_AGENT='Mozilla/5.0 (X11; Linux i686; rv:38.0) Gecko/20100101 Firefox/38.0'
 DESCRIPTION = '''=={{int:filedesc}}==
@@ -75,41 +129,812 @@ AUDIO_QUALITY = [ # Higher index -> "better" quality
                 '250',
                 '172',
                 '251']
+# WebM itags of the non adaptive stream map, 3D versions are ranked lowest
+LEGACY_QUALITY = ['102', '100', '101', '43', '44', '45', '46']
+VIDEO_RANK = dict((itag, rank) for rank, itag in enumerate(VIDEO_QUALITY))
+AUDIO_RANK = dict((itag, rank) for rank, itag in enumerate(AUDIO_QUALITY))
+LEGACY_RANK = dict((itag, rank) for rank, itag in enumerate(LEGACY_QUALITY))
+
+# Matches the parts of the watch page used by Youtube.metadata: the
+# license, the stream maps and the unavailable message.
+watchpagepat = re.compile(
+    r'<h4>License:</h4>([\s\S]*?)</p>'
+    r'|"(url_encoded_fmt_stream_map|adaptive_fmts)".*?"(.*?)"'
+    r'|(<h1 id="unavailable-message" class="message">)')
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+MEDIA_NS = '{http://search.yahoo.com/mrss/}'
+YT_NS = '{http://gdata.youtube.com/schemas/2007}'
 
 # This pattern matches a character entity reference (a decimal numeric
 # references, a hexadecimal numeric reference, or a named reference).
 charrefpat = re.compile(r'&(#(\d+|x[\da-fA-F]+)|[\w.:-]+);?')
 
+def entitydecode(match):
+    entity = match.group(1)
+    if entity.startswith('#x'):
+        return unichr(int(entity[2:], 16))
+    elif entity.startswith('#'):
+        return unichr(int(entity[1:]))
+    elif entity in name2codepoint:
+        return unichr(name2codepoint[entity])
+    else:
+        return match.group(0)
+
 def decode_html(html):
     """
-    >>> decodeHtml('me &amp; you and &#36;&#38;%')
+    >>> decode_html('me &amp; you and &#36;&#38;%')
     u'me & you and $&%'
     """
-    if type(html) != unicode:
-        html = unicode(html)[:]
-    if type(html) is unicode:
-        uchr = unichr
-    else:
-        uchr = lambda value: value > 255 and unichr(value) or chr(value)
-    def entitydecode(match, uchr=uchr):
-        entity = match.group(1)
-        if entity.startswith('#x'):
-            return uchr(int(entity[2:], 16))
-        elif entity.startswith('#'):
-            return uchr(int(entity[1:]))
-        elif entity in name2codepoint:
-            return uchr(name2codepoint[entity])
-        else:
-            return match.group(0)
+    if not isinstance(html, unicode):
+        html = unicode(html)
     return charrefpat.sub(entitydecode, html).replace(u'\xa0', ' ')
 
 def format_time(seconds):
-    ms = int(seconds * 1000)
-    h = int(ms % 86400000 / 3600000)
-    m = int(ms % 3600000 / 60000)
-    s = int(ms % 60000 / 1000)
-    ms = ms % 1000
-    return "%02d:%02d:%02d,%03d" % (h, m, s, ms)
+    return format_times([seconds])[0]
+
+def format_times(times):
+    """Format a list of times in seconds as SRT timestamps."""
+    return ["%02d:%02d:%02d,%03d" % (ms / 3600000 % 24, ms / 60000 % 60, ms / 1000 % 60, ms % 1000)
+            for ms in [int(seconds * 1000) for seconds in times]]
+
+def readahead(iterable, size=1):
+    """
+    Iterate over iterable in a background thread, keeping up to size items
+    ready so that producing the next item overlaps with consuming this one.
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    queue = Queue.Queue(size)
+    stop = threading.Event()
+    def put(entry):
+        # give up once the consumer stopped, it no longer empties the queue
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception:
+            put((False, sys.exc_info()))
+    thread = threading.Thread(target=METRICS.bind(produce))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if not ok:
+                if item:
+                    raise item[0], item[1], item[2]
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def pmap(function, items, threads):
+    """
+    Return [function(item) for item in items], computed by up to threads
+    threads. The first exception raised is re-raised once all threads are
+    done, remaining items are skipped after an error.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for i in range(len(items)):
+        queue.put(i)
+    def run():
+        while not errors:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = function(items[i])
+            except Exception:
+                errors.append(sys.exc_info())
+    run = METRICS.bind(run)
+    workers = [threading.Thread(target=run) for i in range(min(threads, len(items)))]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+def prefetch(function, items, size):
+    """
+    Iterate over items while function(item) is called for up to size items
+    ahead in background threads. An item is yielded once its call is done,
+    so that the consumer finds what it fetched. Errors are ignored, the
+    consumer runs into them again.
+    """
+    pending = collections.deque()
+    def start(item):
+        done = threading.Event()
+        def run():
+            try:
+                function(item)
+            except Exception:
+                pass
+            finally:
+                done.set()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        pending.append((item, done))
+    for item in items:
+        if size < 1:
+            yield item
+            continue
+        start(item)
+        if len(pending) >= size:
+            item, done = pending.popleft()
+            done.wait()
+            yield item
+    while pending:
+        item, done = pending.popleft()
+        done.wait()
+        yield item
+
+def parallel(calls):
+    """
+    Run the callables in calls concurrently, each in its own thread, and
+    return their results. The first exception raised is re-raised.
+    """
+    return pmap(lambda call: call(), calls, len(calls))
+
+class Return(Exception):
+    """Raised by a coroutine run by an Engine to return value."""
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+class Future(object):
+    """The outcome of a call or coroutine run by an Engine."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.event.is_set()
+
+    def set_result(self, value, error=None):
+        """Complete with value, or with error, an exc_info tuple."""
+        with self.lock:
+            self.value, self.error = value, error
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once done, right away if done already."""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self):
+        """Wait until done, returns the value or raises the error."""
+        # wait in steps, so that KeyboardInterrupt gets through
+        while not self.event.wait(1):
+            pass
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+class Engine(object):
+    """
+    Runs blocking calls on a pool of up to threads threads, and coroutines on
+    top of them. A coroutine is a generator yielding Futures, or lists of
+    Futures, that is resumed with their results once they are done or has
+    their error raised, and ends with raise Return(value). A waiting
+    coroutine holds no thread, so that many imports can be in progress while
+    only threads blocking calls run at a time.
+
+    Example:
+        engine = Engine(16)
+        yt = engine.wrap(Youtube())
+        def titles(ids):
+            infos = yield [yt.info(id) for id in ids]
+            raise Return([info['title'] for info in infos])
+        engine.run(titles(ids))
+    """
+
+    def __init__(self, threads=16):
+        self.threads = threads
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        """Call function(*args, **kwargs) on the pool, returns its Future."""
+        future = Future()
+        self.queue.put((future, METRICS.bind(function), args, kwargs))
+        with self.lock:
+            if len(self.workers) < self.threads:
+                worker = threading.Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        return future
+
+    def work(self):
+        while True:
+            future, function, args, kwargs = self.queue.get()
+            try:
+                value = function(*args, **kwargs)
+            except Exception:
+                future.set_result(None, sys.exc_info())
+            else:
+                future.set_result(value)
+
+    def gather(self, futures):
+        """Return a Future of the results of futures, a Future or a list of them."""
+        if isinstance(futures, Future):
+            return futures
+        futures = list(futures)
+        gathered = Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+        def done(future):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            errors = [f.error for f in futures if f.error]
+            gathered.set_result([f.value for f in futures], errors[0] if errors else None)
+        if not futures:
+            gathered.set_result([])
+        for future in futures:
+            future.add_done_callback(done)
+        return gathered
+
+    def spawn(self, coroutine):
+        """
+        Start the generator coroutine, returns a Future of its return value.
+        The coroutine and its calls are attributed to the current job.
+        """
+        future = Future()
+        job = METRICS.current()
+        def step(value=None, error=None):
+            with METRICS.job(job):
+                resume(value, error)
+        def resume(value, error):
+            # resume the coroutine until it waits for a Future that is not done
+            while True:
+                try:
+                    if error:
+                        yielded = coroutine.throw(*error)
+                    else:
+                        yielded = coroutine.send(value)
+                except Return, e:
+                    return future.set_result(e.value)
+                except StopIteration:
+                    return future.set_result(None)
+                except Exception:
+                    return future.set_result(None, sys.exc_info())
+                waiting = self.gather(yielded)
+                if not waiting.done():
+                    return waiting.add_done_callback(lambda done: step(done.value, done.error))
+                value, error = waiting.value, waiting.error
+        step()
+        return future
+
+    def run(self, coroutine):
+        """Run coroutine to its end and return its value."""
+        return self.spawn(coroutine).result()
+
+    def wrap(self, obj):
+        """Return the asynchronous counterpart of obj, see AsyncProxy."""
+        return AsyncProxy(self, obj)
+
+class AsyncProxy(object):
+    """
+    Asynchronous counterpart of an object like Youtube or Mediawiki: calling
+    a method submits the call to engine and returns its Future.
+    """
+
+    def __init__(self, engine, obj):
+        self.engine = engine
+        self.obj = obj
+
+    def __getattr__(self, name):
+        method = getattr(self.obj, name)
+        def call(*args, **kwargs):
+            return self.engine.submit(method, *args, **kwargs)
+        return call
+
+class Slots(object):
+    """
+    Semaphore for coroutines, acquire returns a Future that is done once one
+    of size slots is free.
+    """
+
+    def __init__(self, size):
+        self.free = size
+        self.waiting = collections.deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        future = Future()
+        with self.lock:
+            if not self.free:
+                self.waiting.append(future)
+                return future
+            self.free -= 1
+        future.set_result(None)
+        return future
+
+    def release(self):
+        with self.lock:
+            if not self.waiting:
+                self.free += 1
+                return
+            future = self.waiting.popleft()
+        future.set_result(None)
+
+def sha1sum(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for data in iter(lambda: f.read(DOWNLOAD_BLOCKSIZE), ''):
+            sha1.update(data)
+    return sha1.hexdigest()
+
+class FileHash(object):
+    """
+    SHA-1 of a file that is written in blocks, possibly out of order. Blocks
+    written at the end of the hashed part are hashed as they come in,
+    blocks written further ahead are read back from the file once the gap
+    before them is filled.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.sha1 = hashlib.sha1()
+        self.position = 0
+        self.pending = {}
+        # whether a thread is hashing from position on
+        self.hashing = False
+        self.lock = threading.Lock()
+
+    def update(self, offset, data):
+        """Account for data that was written to the file at offset."""
+        with self.lock:
+            if offset != self.position or self.hashing:
+                if offset >= self.position:
+                    self.pending[offset] = offset + len(data)
+                return
+            self.hashing = True
+        # this thread hashes up to the next gap, outside of the lock, while
+        # the other writers only record their blocks
+        self.sha1.update(data)
+        end = offset + len(data)
+        while True:
+            with self.lock:
+                self.position = end
+                end = self.pending.pop(end, None)
+                if end is None:
+                    self.hashing = False
+                    return
+            self.read(self.position, end)
+
+    def read(self, position, end=None):
+        """Hash the file from position to end, returns the position reached."""
+        with open(self.filename, 'rb') as f:
+            f.seek(position)
+            while end is None or position < end:
+                size = DOWNLOAD_BLOCKSIZE
+                if end is not None:
+                    size = min(size, end - position)
+                data = f.read(size)
+                if not data:
+                    break
+                self.sha1.update(data)
+                position += len(data)
+        return position
+
+    def hexdigest(self):
+        """Return the SHA-1 of the whole file, hashing what is not hashed yet."""
+        with self.lock:
+            self.pending = {}
+            self.position = self.read(self.position)
+            return self.sha1.hexdigest()
+
+class Metrics(object):
+    """
+    Counters and histograms of imports, i.e. requests, bytes, retries,
+    phase durations and chunk upload latency. With a file, phases and
+    chunks are logged to it as JSON lines as they finish, followed by a
+    summary, or the totals are written to it in the Prometheus text format.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    PREFIX = 'youtube2mediawiki_'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.local = threading.local()
+        self.filename = None
+        self.format = 'json'
+        self.log = None
+
+    def open(self, filename, format='json'):
+        """Export to filename as 'json' lines or in the 'prometheus' format."""
+        self.filename = filename
+        self.format = format
+        if format == 'json':
+            self.log = open(filename, 'a')
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0] * (len(self.BUCKETS) + 2))
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def event(self, event, **fields):
+        """Log event with fields and the current job as a line of JSON."""
+        if self.log:
+            fields.update(time=time.time(), event=event, job=self.current())
+            line = json.dumps(fields)
+            with self.lock:
+                self.log.write(line + '\n')
+                self.log.flush()
+
+    def current(self):
+        """Return the id of the import the current thread works on."""
+        return getattr(self.local, 'job', None)
+
+    @contextmanager
+    def job(self, id):
+        """Attribute the events of the current thread to the import of id."""
+        previous = self.current()
+        self.local.job = id
+        try:
+            yield
+        finally:
+            self.local.job = previous
+
+    def bind(self, function):
+        """Return function, attributing its events to the current job in any thread."""
+        job = self.current()
+        def call(*args, **kwargs):
+            with self.job(job):
+                return function(*args, **kwargs)
+        return call
+
+    @contextmanager
+    def phase(self, name):
+        """Record the duration of phase name of the current job."""
+        started = time.time()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            seconds = time.time() - started
+            self.observe('phase_seconds', seconds, phase=name)
+            self.event('phase', phase=name, seconds=seconds, error=error)
+
+    def write(self):
+        """
+        Replace the Prometheus file with the current totals. Errors are only
+        reported, a failed export does not fail the import.
+        """
+        if self.filename and self.format == 'prometheus':
+            tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+            try:
+                with self.lock:
+                    with open(tmp, 'w') as f:
+                        f.write(self.prometheus())
+                    os.rename(tmp, self.filename)
+            except (IOError, OSError), e:
+                print 'WARNING: can not write metrics to %s: %s' % (self.filename, e)
+
+    def close(self):
+        """Write the totals, as a summary line in the JSON format."""
+        if self.log:
+            with self.lock:
+                counters = dict((self.name(*key), value) for key, value in self.counters.items())
+                histograms = dict((self.name(*key), {'sum': value[-2], 'count': value[-1]})
+                                  for key, value in self.histograms.items())
+            self.event('summary', counters=counters, histograms=histograms)
+            self.log.close()
+            self.log = None
+        self.write()
+
+    def name(self, name, labels, extra=()):
+        labels = labels + extra
+        if not labels:
+            return name
+        return '%s{%s}' % (name, ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                                          for key, value in labels))
+
+    def prometheus(self):
+        """Return the totals in the Prometheus text format, called with lock held."""
+        lines = []
+        types = {}
+        for name, labels in sorted(self.counters):
+            if name not in types:
+                lines.append('# TYPE %s%s_total counter' % (self.PREFIX, name))
+                types[name] = True
+            lines.append('%s %s' % (self.name(self.PREFIX + name + '_total', labels),
+                                    self.counters[(name, labels)]))
+        for name, labels in sorted(self.histograms):
+            histogram = self.histograms[(name, labels)]
+            if name not in types:
+                lines.append('# TYPE %s%s histogram' % (self.PREFIX, name))
+                types[name] = True
+            total = 0
+            for bound, count in zip(self.BUCKETS, histogram):
+                total += count
+                lines.append('%s %d' % (self.name(self.PREFIX + name + '_bucket', labels,
+                                                  (('le', bound), )), total))
+            lines.append('%s %d' % (self.name(self.PREFIX + name + '_bucket', labels,
+                                              (('le', '+Inf'), )), histogram[-1]))
+            lines.append('%s %s' % (self.name(self.PREFIX + name + '_sum', labels), histogram[-2]))
+            lines.append('%s %d' % (self.name(self.PREFIX + name + '_count', labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+class ConnectionPool(object):
+    """
+    Persistent HTTP(S) connections shared by all openers of the process.
+    At most MAX_CONNECTIONS connections per host are in use at once, idle
+    connections are kept for reuse.
+    """
+    IDLE_TIMEOUT = 30
+    WAIT_TIMEOUT = 300
+
+    def __init__(self):
+        self.idle = {}
+        self.active = {}
+        self.condition = threading.Condition()
+
+    def get(self, key, connect):
+        """Return (connection, reused) for key, calling connect() if none is idle."""
+        with self.condition:
+            started = time.time()
+            while self.active.get(key, 0) >= MAX_CONNECTIONS:
+                if time.time() - started > self.WAIT_TIMEOUT:
+                    # do not wait forever on connections that were never released
+                    if DEBUG:
+                        print 'Connection limit for %s ignored' % key[1]
+                    break
+                self.condition.wait(1)
+            self.active[key] = self.active.get(key, 0) + 1
+            idle = self.idle.get(key, [])
+            while idle:
+                conn, since = idle.pop()
+                if time.time() - since < self.IDLE_TIMEOUT and not self.closed(conn):
+                    return conn, True
+                conn.close()
+        return connect(), False
+
+    def closed(self, conn):
+        """Whether the server closed the idle connection conn."""
+        # an idle connection is only readable once the server closed it
+        return not conn.sock or bool(select.select([conn.sock], [], [], 0)[0])
+
+    def put(self, key, conn, reuse=True):
+        """Release conn, keeping it for reuse if reuse is true."""
+        with self.condition:
+            if reuse:
+                self.idle.setdefault(key, []).append((conn, time.time()))
+            else:
+                conn.close()
+            self.active[key] -= 1
+            self.condition.notify()
+
+CONNECTION_POOL = ConnectionPool()
+
+class PooledResponse(object):
+    """
+    Body of a response on a pooled connection. The connection is returned
+    to the pool once the body has been read, or dropped if it is closed
+    before that.
+    """
+
+    def __init__(self, response, release):
+        self.response = response
+        self.release = release
+
+    def recv(self, amt=None):
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self.close()
+        return data
+    read = recv
+
+    def close(self):
+        if self.release:
+            release, self.release = self.release, None
+            if not self.response.isclosed() and self.response.length is not None \
+                and self.response.length <= BLOCKSIZE:
+                self.response.read()
+            release(self.response.isclosed() and not self.response.will_close)
+
+    def __del__(self):
+        self.close()
+
+class KeepAliveHandler(urllib2.HTTPHandler):
+    """
+    HTTP handler reusing connections from CONNECTION_POOL. A request that
+    fails on a reused connection is sent again on a new one, unless it
+    might have been processed already and is not idempotent.
+    """
+    connection_class = httplib.HTTPConnection
+    IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, pool=None):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool or CONNECTION_POOL
+
+    def connect(self, host, req):
+        return self.connection_class(host, timeout=req.timeout)
+
+    def http_open(self, req):
+        return self.keepalive_open(req)
+
+    def keepalive_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (req.get_type(), host, req._tunnel_host)
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        tunnel_headers = {}
+        if req._tunnel_host and 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+        while True:
+            conn, reused = self.pool.get(key, lambda: self.connect(host, req))
+            if req._tunnel_host and not reused:
+                conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            sent = False
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                sent = True
+                r = conn.getresponse(buffering=True)
+                break
+            except (socket.error, httplib.HTTPException), e:
+                self.pool.put(key, conn, False)
+                # the server may have closed an idle connection, try a new one
+                if not reused or (sent and req.get_method() not in self.IDEMPOTENT):
+                    raise urllib2.URLError(e)
+                METRICS.count('retries', kind='connection')
+                if req.has_data() and hasattr(req.data, 'read'):
+                    if not hasattr(req.data, 'reset'):
+                        raise urllib2.URLError(e)
+                    req.data.reset()
+            except:
+                # i.e. the body could not be read, the connection is half written
+                self.pool.put(key, conn, False)
+                raise
+        METRICS.count('http_requests', host=host, reused=reused)
+        fp = PooledResponse(r, lambda reuse: self.pool.put(key, conn, reuse))
+        resp = addinfourl(socket._fileobject(fp, close=True), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+class KeepAliveHTTPSHandler(KeepAliveHandler, urllib2.HTTPSHandler):
+    """HTTPS handler reusing connections from CONNECTION_POOL."""
+    connection_class = httplib.HTTPSConnection
+
+    def __init__(self, pool=None):
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool or CONNECTION_POOL
+
+    def connect(self, host, req):
+        return self.connection_class(host, timeout=req.timeout, context=self._context)
+
+    def https_open(self, req):
+        return self.keepalive_open(req)
+
+class DecompressedResponse(object):
+    """
+    Body of a gzip or deflate encoded response, decompressed while it is
+    read, at most amt bytes at a time.
+    """
+
+    def __init__(self, fp, encoding):
+        self.fp = fp
+        self.encoding = encoding
+        self.decompressor = zlib.decompressobj(
+            zlib.MAX_WBITS if encoding == 'deflate' else 16 + zlib.MAX_WBITS)
+        self.started = False
+        self.rest = ''
+        self.done = False
+
+    def decompress(self, data, amt):
+        if not self.started and self.encoding == 'deflate':
+            self.started = True
+            try:
+                return self.decompressor.decompress(data, amt)
+            except zlib.error:
+                # some servers send deflate data without the zlib header
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(data, amt)
+
+    def recv(self, amt=None):
+        amt = amt or BLOCKSIZE
+        while not self.done:
+            data = self.decompressor.unconsumed_tail or self.fp.read(BLOCKSIZE)
+            if not data:
+                self.done = True
+                self.rest = self.decompressor.flush()
+                break
+            data = self.decompress(data, amt)
+            if data:
+                return data
+        data, self.rest = self.rest[:amt], self.rest[amt:]
+        return data
+    read = recv
+
+    def close(self):
+        self.fp.close()
+
+class DecompressHandler(urllib2.BaseHandler):
+    """
+    Accept gzip and deflate encoded responses and decompress them while they
+    are read. Range and HEAD requests are sent without Accept-Encoding, as
+    their offsets and sizes refer to the unencoded body.
+    """
+
+    def http_request(self, req):
+        if not req.has_header('Range') and not req.has_header('Accept-encoding') \
+            and req.get_method() != 'HEAD':
+            req.add_unredirected_header('Accept-Encoding', 'gzip, deflate')
+        return req
+    https_request = http_request
+
+    def http_response(self, req, resp):
+        encoding = resp.info().get('Content-Encoding', '').strip().lower()
+        if encoding not in ('gzip', 'x-gzip', 'deflate'):
+            return resp
+        METRICS.count('compressed_responses', encoding=encoding)
+        fp = DecompressedResponse(resp, encoding)
+        decompressed = addinfourl(socket._fileobject(fp, close=True), resp.info(), resp.geturl())
+        decompressed.code = resp.code
+        decompressed.msg = resp.msg
+        return decompressed
+    https_response = http_response
+
+def build_opener(*handlers):
+    """
+    urllib2.build_opener using persistent connections from CONNECTION_POOL
+    and compressed responses.
+    """
+    return urllib2.build_opener(KeepAliveHandler(), KeepAliveHTTPSHandler(), DecompressHandler(),
+                                *handlers)
 
 class Youtube:
     '''
@@ -119,84 +944,248 @@ class Youtube:
     '''
     def __init__(self):
         self.cj = cookielib.CookieJar()
-        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cj))
+        self.opener = build_opener(urllib2.HTTPCookieProcessor(self.cj))
         self.opener.addheaders = [
             ('User-Agent', YOUTUBE_USER_AGENT),
             ('Accept-Language', 'en-us, en;q=0.50')
         ]
+        # bounds concurrent downloads if shared between threads
+        self.download_slots = threading.BoundedSemaphore(MAX_DOWNLOADS)
+        self.pages = {}
+        self.pages_lock = threading.Lock()
+        # info and subtitle languages fetched ahead by preload, used once
+        self.preloaded = {}
+        # when the entries of the videos listed by playlist were last updated
+        self.listed = {}
+
+    def metadata(self, id):
+        '''
+        Fetch the watch page of id once and return what is needed from it:
+        license, stream maps and whether the video is unavailable. Results
+        are kept for CACHE_TTL seconds, in CACHE_DIR if set.
+        '''
+        with self.pages_lock:
+            page = self.pages.get(id)
+        cache = CACHE_DIR and os.path.join(CACHE_DIR, '%s.json' % id)
+        if not page and cache and os.path.exists(cache):
+            try:
+                with open(cache) as f:
+                    page = json.load(f)
+            except ValueError:
+                page = None
+        if page and page['time'] + CACHE_TTL > time.time():
+            with self.pages_lock:
+                self.pages.setdefault(id, page)
+                return self.pages[id]
+        url = "%s/watch?v=%s" % (YOUTUBE_URL, id)
+        u = self.opener.open(url)
+        data = u.read()
+        u.close()
+        page = {
+            'time': time.time(),
+            'license': None,
+            'url_encoded_fmt_stream_map': None,
+            'adaptive_fmts': None,
+            'unavailable': False
+        }
+        for match in watchpagepat.finditer(data):
+            license, key, stream_map, unavailable = match.groups()
+            if license is not None and page['license'] is None:
+                page['license'] = re.sub('<.+?>', '', license.strip()).strip()
+            elif key and page[key] is None:
+                page[key] = stream_map
+            elif unavailable:
+                page['unavailable'] = True
+        with self.pages_lock:
+            # drop the expired pages of videos that were not imported
+            for key in [key for key, value in self.pages.items()
+                        if value['time'] + CACHE_TTL <= page['time']]:
+                del self.pages[key]
+            self.pages[id] = page
+        if cache:
+            if not os.path.exists(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            with open(cache + '.tmp', 'w') as f:
+                json.dump(page, f)
+            os.rename(cache + '.tmp', cache)
+        return page
+
+    def preload(self, id):
+        '''
+        Fetch info and subtitle languages of id ahead of its import, the next
+        call of info and subtitle_languages for id returns them.
+        '''
+        preloaded = {'info': self.info(id)}
+        if not OVERWRITE:
+            preloaded['languages'] = self.subtitle_languages(id)
+        with self.pages_lock:
+            self.preloaded[id] = preloaded
+
+    def forget(self, id):
+        '''Drop what is kept of id once its import is done.'''
+        with self.pages_lock:
+            self.pages.pop(id, None)
+            self.preloaded.pop(id, None)
+
+    def take_preloaded(self, id, key):
+        with self.pages_lock:
+            preloaded = self.preloaded.get(id, {})
+            value = preloaded.pop(key, None)
+            if not preloaded:
+                self.preloaded.pop(id, None)
+        return value
+
+    def playlist(self, feed):
+        '''
+        Yield the ids of the videos in the gdata feed feed, the path of a
+        playlist or the uploads of a channel. Pages of FEED_PAGE_SIZE entries
+        are fetched as the ids are consumed. The time each entry was last
+        updated is kept in listed.
+        '''
+        url = "%s%s?v=2&start-index=1&max-results=%d" % (GDATA_URL, feed, FEED_PAGE_SIZE)
+        while url:
+            u = self.opener.open(url)
+            ids = []
+            url = None
+            for event, e in iterparse(u):
+                if e.tag == ATOM_NS + 'link' and e.get('rel') == 'next':
+                    url = e.get('href')
+                elif e.tag == ATOM_NS + 'entry':
+                    id = e.findtext('.//' + YT_NS + 'videoid')
+                    if id:
+                        ids.append(id)
+                        with self.pages_lock:
+                            self.listed[id] = e.findtext(ATOM_NS + 'updated')
+                    e.clear()
+            u.close()
+            for id in ids:
+                yield id
 
     def info(self, id):
-        def get_data(e):
-            return e.firstChild and e.firstChild.data or ''
+        preloaded = self.take_preloaded(id, 'info')
+        if preloaded:
+            return preloaded
         info = {}
-        url = "http://gdata.youtube.com/feeds/api/videos/%s?v=2" % id
+        url = "%s/feeds/api/videos/%s?v=2" % (GDATA_URL, id)
         u = self.opener.open(url)
-        data = u.read()
+        # parse the entry while it is downloaded
+        parser = iterparse(u)
+        for event, e in parser:
+            pass
         u.close()
-        xml = parseString(data)
-        info['url'] = 'http://www.youtube.com/watch?v=%s'%id
-        info['title'] = get_data(xml.getElementsByTagName('title')[0])
-        info['description'] = get_data(xml.getElementsByTagName('media:description')[0])
-        info['date'] = xml.getElementsByTagName('published')[0].firstChild.data.split('T')[0]
-        info['author'] = "https://www.youtube.com/user/%s"%xml.getElementsByTagName('uri')[0].firstChild.data.split('/')[-1]
+        entry = parser.root
+        group = MEDIA_NS + 'group/' + MEDIA_NS
+        def field(path):
+            return entry.findtext(path) or u''
+        info['url'] = '%s/watch?v=%s' % (YOUTUBE_URL, id)
+        info['title'] = field(ATOM_NS + 'title')
+        info['description'] = field(group + 'description')
+        info['date'] = field(ATOM_NS + 'published').split('T')[0]
+        info['author'] = "https://www.youtube.com/user/%s"%field(ATOM_NS + 'author/' + ATOM_NS + 'uri').split('/')[-1]
 
-        info['categories'] = []
-        for cat in xml.getElementsByTagName('media:category'):
-            info['categories'].append(cat.firstChild.data)
+        info['categories'] = [e.text for e in entry.findall(group + 'category')]
 
         info['keywords'] = []
-        keywords = get_data(xml.getElementsByTagName('media:keywords')[0])
+        keywords = field(group + 'keywords')
         if keywords:
             info['keywords'] = keywords.split(', ')
         info['wiki_categories'] = '\n'.join(['[[Category:%s]]'%c for c in info['categories']])
 
-        url = "http://www.youtube.com/watch?v=%s" % id
-        u = self.opener.open(url)
-        data = u.read()
-        u.close()
-        match = re.compile('<h4>License:</h4>(.*?)</p>', re.DOTALL).findall(data)
-        if match:
-            info['license'] = match[0].strip()
-            info['license'] = re.sub('<.+?>', '', info['license']).strip()
+        license = self.metadata(id)['license']
+        if license is not None:
+            info['license'] = license
         return info
 
     def subtitle_languages(self, id):
-        url = "http://www.youtube.com/api/timedtext?hl=en&type=list&tlangs=1&v=%s&asrs=1"%id
+        preloaded = self.take_preloaded(id, 'languages')
+        if preloaded is not None:
+            return preloaded
+        url = "%s/api/timedtext?hl=en&type=list&tlangs=1&v=%s&asrs=1" % (YOUTUBE_URL, id)
         u = self.opener.open(url)
-        data = u.read()
+        languages = [t.get('lang_code') for event, t in iterparse(u) if t.tag == 'track']
         u.close()
-        xml = parseString(data)
-        return [t.getAttribute('lang_code') for t in xml.getElementsByTagName('track')]
+        return languages
 
     def subtitles(self, id, language='en'):
-        url = "http://www.youtube.com/api/timedtext?hl=en&v=%s&type=track&lang=%s&name&kind"%(id, language)
+        url = "%s/api/timedtext?hl=en&v=%s&type=track&lang=%s&name&kind" % (YOUTUBE_URL, id, language)
         u = self.opener.open(url)
-        data = u.read()
+        times = []
+        texts = []
+        # parse the track while it is downloaded
+        for event, t in iterparse(u):
+            if t.tag == 'text':
+                start = float(t.get('start'))
+                duration = t.get('dur') or '2'
+                times.append(start)
+                times.append(start + float(duration))
+                texts.append(decode_html(t.text or u''))
+                t.clear()
         u.close()
-        xml = parseString(data)
-        srt = u''
-        n = 0
-        for t in xml.getElementsByTagName('text'):
-            start = float(t.getAttribute('start'))
-            duration = t.getAttribute('dur')
-            if not duration:
-                duration = '2'
-            end = start + float(duration)
-            text = t.firstChild.data
-            srt += u'%s\n%s --> %s\n%s\n\n' % (
-                    n, 
-                    format_time(start),
-                    format_time(end),
-                    decode_html(text))
-            n += 1
-        return srt
-
-    def find_max(self, keys, quality):
-        max_itag_index = -1
-        for key in keys:
-            if quality.index(key) > max_itag_index:
-                max_itag_index = quality.index(key)
-        return quality[max_itag_index]
+        times = format_times(times)
+        return u''.join([u'%s\n%s --> %s\n%s\n\n' % (n, times[2 * n], times[2 * n + 1], text)
+                         for n, text in enumerate(texts)])
+
+    def all_subtitles(self, id, languages):
+        """Return the subtitles of id for all languages, fetched concurrently."""
+        return pmap(lambda language: self.subtitles(id, language), languages, SUBTITLE_THREADS)
+
+    def ranked(self, streams, rank):
+        '''Return the streams, best first by rank of their itag and bitrate.'''
+        return sorted(streams.values(), reverse=True,
+                      key=lambda stream: (rank.get(stream['itag'], -1), int(stream.get('bitrate') or 0)))
+
+    def probe(self, stream):
+        '''
+        Return the url of stream, its size and whether range requests are
+        supported. The server is asked with a HEAD request only once.
+        '''
+        url = self.get_url(stream)
+        if 'ranges' not in stream:
+            try:
+                stream['length'], stream['ranges'] = self.head(url)
+            except (IOError, httplib.HTTPException):
+                stream['length'], stream['ranges'] = 0, False
+        return url, stream['length'], stream['ranges']
+
+    def stream_size(self, stream):
+        '''
+        Return the size of stream in bytes, estimated from its clen or from
+        bitrate and duration, with a HEAD request if neither is known. None
+        if the size can not be determined.
+        '''
+        if 'size' not in stream:
+            query = dict((k, v[0]) for k, v in parse_qs(urlparse(stream.get('url', '')).query).items())
+            clen = stream.get('clen') or query.get('clen')
+            duration = stream.get('dur') or query.get('dur')
+            if clen:
+                stream['size'] = int(clen)
+            elif duration and stream.get('bitrate'):
+                stream['size'] = int(float(duration) * int(stream['bitrate']) / 8)
+            else:
+                stream['size'] = self.probe(stream)[1] or None
+        return stream['size']
+
+    def select_streams(self, video_streams, audio_streams, max_size=None):
+        '''
+        Return the best video stream and, with MERGE_DASH, the best audio
+        stream whose sizes add up to at most max_size bytes. Streams of
+        unknown size are assumed to fit.
+        '''
+        videos = self.ranked(video_streams, VIDEO_RANK if MERGE_DASH else LEGACY_RANK)
+        audios = self.ranked(audio_streams, AUDIO_RANK) if MERGE_DASH else [None]
+        if not audios:
+            raise PermanentError('No WebM audio found')
+        if not max_size:
+            return videos[0], audios[0]
+        smallest = None
+        for video in videos:
+            for audio in audios:
+                size = sum(self.stream_size(stream) or 0 for stream in (video, audio) if stream)
+                if size <= max_size:
+                    return video, audio
+                smallest = min(smallest or size, size)
+        raise PermanentError('No WebM video of at most %.1f MB found, the smallest is %.1f MB' % (
+            max_size / 1048576.0, smallest / 1048576.0))
 
     def get_url(self, stream):
         if 'sig' in stream:
@@ -207,41 +1196,30 @@ class Youtube:
             raise Exception('No download URL found')
         return url
 
-    def get_urls(self, video_streams, audio_streams):
-        if not MERGE_DASH: # == not audio_streams
-            # for non adaptive streams a higher itag simply means higher quality
-            max_v_itag = max(video_streams.keys())
-            if DEBUG:
-                print ('Getting download url for itag=' + max_v_itag)
-            video_url = self.get_url(video_streams[max_v_itag])
-            audio_url = '' # audio and video in one file
-            return video_url, audio_url
-        max_v_itag = self.find_max(video_streams.keys(), VIDEO_QUALITY)
-        max_a_itag = self.find_max(audio_streams.keys(), AUDIO_QUALITY)
-        if DEBUG:
-            print 'Getting download urls for itags=[' + max_v_itag + ', ' + max_a_itag + ']'
-        audio_url = self.get_url(audio_streams[max_a_itag])
-        video_url = self.get_url(video_streams[max_v_itag])
-        return video_url, audio_url
-
-    def download(self, id, *filenames):
+    def streams(self, id, max_size=None):
+        '''
+        Return the video and audio stream of id that download() fetches.
+        The stream map is parsed once per page, so that sizes found for its
+        streams are kept.
+        '''
         if MERGE_DASH: # == len(filenames)==2
-             format_map_regex = '"adaptive_fmts".*?"(.*?)"'
+             format_map = 'adaptive_fmts'
         else: # len(filenames)==1:
-             format_map_regex = '"url_encoded_fmt_stream_map".*?"(.*?)"'
+             format_map = 'url_encoded_fmt_stream_map'
         video_stream_type = 'video/webm'
         audio_stream_type = 'audio/webm'
-        unavailable_message = '<h1 id="unavailable-message" class="message">'
-        url = "http://www.youtube.com/watch?v=%s" % id
-        u = self.opener.open(url)
-        data = u.read()
-        u.close()
-        match = re.compile(format_map_regex).findall(data)
-        if not match and unavailable_message in data:
-            raise Exception("YouTube video not available")
+        page = self.metadata(id)
+        if not page[format_map]:
+            if page['unavailable']:
+                raise PermanentError("YouTube video not available")
+            raise PermanentError('No WebM video found')
+        with self.pages_lock:
+            parsed = page.setdefault('streams', {}).get(format_map)
+        if parsed:
+            return self.select_streams(parsed[0], parsed[1], max_size)
         video_streams = {}
         audio_streams = {}
-        for x in match[0].split(','):
+        for x in page[format_map].split(','):
             stream = {}
             for s in x.split('\\u0026'):
                 key, value = s.split('=')
@@ -252,36 +1230,309 @@ class Youtube:
             if stream['type'].startswith(audio_stream_type) and MERGE_DASH:
                 audio_streams[stream['itag']] = stream
         if video_streams: # and not (audio_streams xor MERGE_DASH)
-            urls = self.get_urls(video_streams, audio_streams)
+            with self.pages_lock:
+                video_streams, audio_streams = page['streams'].setdefault(
+                    format_map, (video_streams, audio_streams))
+            return self.select_streams(video_streams, audio_streams, max_size)
         else:
-            raise Exception('No WebM video found')
+            raise PermanentError('No WebM video found')
 
-        #download stream and save to file.
-        for i, url in enumerate(urls):
-            if not url:
-                break
-            u = self.opener.open(url)
-            f = open(filenames[i], 'w')
-            data = True
-            while data:
-                data = u.read(4096)
-                f.write(data)
-            f.close()
-            u.close()
-        return True
+    def download_streams(self, id, max_size=None):
+        '''
+        Return url, size and whether range requests are supported for the
+        video and audio stream of id, None for the audio stream without
+        MERGE_DASH.
+        '''
+        streams = self.streams(id, max_size)
+        if DEBUG:
+            print 'Getting download urls for itags=%s' % [stream['itag'] for stream in streams if stream]
+        return [stream and self.probe(stream) for stream in streams]
+
+    def download_size(self, id, max_size=None):
+        '''Return the size in bytes of the streams of id, None if unknown.'''
+        sizes = [self.stream_size(stream) for stream in self.streams(id, max_size) if stream]
+        return None if None in sizes else sum(sizes)
+
+    def download(self, id, *filenames, **kwargs):
+        streams = self.download_streams(id, kwargs.get('max_size'))
+        #download streams and save to files, returns their SHA-1
+        return parallel([
+            lambda stream=stream, filename=filename: self.fetch(filename, *stream)
+            for stream, filename in zip(streams, filenames) if stream
+        ])
+
+    def head(self, url):
+        """Return the size of url and whether range requests are supported."""
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        u = self.opener.open(request)
+        headers = u.info()
+        u.close()
+        size = int(headers.get('Content-Length') or 0)
+        ranges = headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return size, ranges
+
+    def fetch_segment(self, url, write, segment, ranges=True):
+        """
+        Download the bytes segment[0]:segment[1] of url, passing each block
+        to write(offset, data). segment[2] is the position up to which data
+        has been written and is advanced while downloading. With segment[1]
+        None, url is read to the end. Network errors are retried with
+        backoff, continuing at segment[2] if the server supports range
+        requests and at segment[0] otherwise.
+        """
+        retries = 0
+        while segment[1] is None or segment[2] < segment[1]:
+            try:
+                request = urllib2.Request(url)
+                if ranges:
+                    request.add_header('Range', 'bytes=%d-%s' % (
+                        segment[2], '' if segment[1] is None else segment[1] - 1))
+                else:
+                    segment[2] = segment[0]
+                u = self.opener.open(request)
+                if ranges and u.getcode() != 206:
+                    u.close()
+                    raise Exception('Range requests not supported for %s' % url)
+                while segment[1] is None or segment[2] < segment[1]:
+                    size = DOWNLOAD_BLOCKSIZE
+                    if segment[1] is not None:
+                        size = min(size, segment[1] - segment[2])
+                    data = u.read(size)
+                    if not data:
+                        if segment[1] is None:
+                            segment[1] = segment[2]
+                            break
+                        raise IOError('Connection closed at byte %d' % segment[2])
+                    write(segment[2], data)
+                    segment[2] += len(data)
+                    METRICS.count('download_bytes', len(data))
+                u.close()
+            except (IOError, httplib.HTTPException), e:
+                if isinstance(e, urllib2.HTTPError) and e.code < 500:
+                    raise
+                retries += 1
+                if retries > DOWNLOAD_RETRIES:
+                    raise
+                METRICS.count('retries', kind='download')
+                if DEBUG:
+                    print 'Retrying download at byte %d:' % segment[2], e
+                time.sleep(min(2 ** retries, 60))
+
+    def fetch(self, filename, url, size, ranges):
+        """
+        Download url of size bytes to filename. If the server supports range
+        requests, the file is fetched as DOWNLOAD_SEGMENTS segments in
+        parallel into a preallocated filename.part. Progress is recorded in
+        filename.part.json, so that an interrupted download is resumed.
+        Returns the SHA-1 of the file, computed while downloading.
+        """
+        part = filename + '.part'
+        state = part + '.json'
+        segments = None
+        if ranges and os.path.exists(part) and os.path.exists(state):
+            with open(state) as f:
+                saved = json.load(f)
+            if saved.get('size') == size:
+                segments = saved['segments']
+        if segments is None:
+            if size and ranges:
+                n = max(1, min(DOWNLOAD_SEGMENTS, size // DOWNLOAD_BLOCKSIZE))
+                step = size // n
+                segments = [[i * step, (i + 1) * step, i * step] for i in range(n)]
+                segments[-1][1] = size
+            else:
+                segments = [[0, size or None, 0]]
+            with open(part, 'wb') as f:
+                f.truncate(size)
+
+        sha1 = FileHash(part)
+        lock = threading.Lock()
+        saved = [0]
+        def save(force=False):
+            with lock:
+                done = sum(s[2] - s[0] for s in segments)
+                if force or done - saved[0] >= 16 * DOWNLOAD_BLOCKSIZE:
+                    with open(state + '.tmp', 'w') as f:
+                        json.dump({'size': size, 'segments': segments}, f)
+                    os.rename(state + '.tmp', state)
+                    saved[0] = done
+        def fetch_segment(segment):
+            with open(part, 'r+b', 0) as f:
+                def write(offset, data):
+                    f.seek(offset)
+                    f.write(data)
+                    sha1.update(offset, data)
+                    save()
+                try:
+                    self.fetch_segment(url, write, segment, ranges)
+                finally:
+                    if ranges:
+                        save(True)
+        parallel([
+            lambda segment=segment: fetch_segment(segment)
+            for segment in segments if segment[1] is None or segment[2] < segment[1]
+        ])
+        if os.path.exists(state):
+            os.unlink(state)
+        sha1 = sha1.hexdigest()
+        os.rename(part, filename)
+        return sha1
+
+    def merge(self, id, filename, ffmpeg, max_size=None):
+        """
+        Merge the video and audio streams of id into filename while they
+        download, by feeding them to ffmpeg through named pipes.
+        """
+        streams = self.download_streams(id, max_size)
+        pipes = []
+        for kind in ('video', 'audio'):
+            pipe = os.path.join(os.path.dirname(filename), kind + '.pipe')
+            if os.path.exists(pipe):
+                os.unlink(pipe)
+            os.mkfifo(pipe)
+            pipes.append(pipe)
+        process, log = start_ffmpeg(ffmpeg, pipes[0], pipes[1], filename)
+        # set once ffmpeg closed a pipe, it is exiting on its own then
+        stopped = threading.Event()
+        def feed(pipe, url, size, ranges):
+            try:
+                with open_fifo(pipe, process) as f:
+                    position = [0]
+                    def write(offset, data):
+                        # a retry without range requests starts over at 0
+                        data = data[position[0] - offset:]
+                        try:
+                            f.write(data)
+                        except IOError, e:
+                            stopped.set()
+                            raise Exception('ffmpeg stopped reading %s: %s' % (pipe, e))
+                        position[0] += len(data)
+                    self.fetch_segment(url, write, [0, size or None, 0], ranges)
+            except Exception:
+                if not stopped.is_set() and process.poll() is None:
+                    process.terminate()
+                raise
+        try:
+            parallel([
+                lambda stream=stream, pipe=pipe: feed(pipe, *stream)
+                for stream, pipe in zip(streams, pipes)
+            ])
+        except Exception:
+            error = sys.exc_info()
+            if not stopped.is_set() and process.poll() is None:
+                process.terminate()
+            if process.wait() > 0:
+                # ffmpeg failed on its own, its output tells why
+                check_ffmpeg(process, log)
+            raise error[0], error[1], error[2]
+        finally:
+            for pipe in pipes:
+                os.unlink(pipe)
+        check_ffmpeg(process, log)
+
+    def stream(self, id, offset=0, max_size=None):
+        """
+        Start downloading the video of id from offset on in a background
+        thread. Returns a StreamBuffer to read the video from and the size
+        of the video.
+        """
+        url, size, ranges = self.download_streams(id, max_size)[0]
+        if not size:
+            raise Exception('Size of video unknown, can not stream')
+        buffer = StreamBuffer(UPLOAD_READAHEAD * CHUNKSIZE, offset)
+        # without range requests, the buffer skips the data before offset
+        segment = [offset, size, offset] if ranges else [0, size, 0]
+        def produce():
+            try:
+                self.fetch_segment(url, buffer.write_at, segment, ranges)
+                buffer.close()
+            except Exception:
+                buffer.close(sys.exc_info())
+        thread = threading.Thread(target=METRICS.bind(produce))
+        thread.daemon = True
+        thread.start()
+        return buffer, size
+
+class StreamBuffer(object):
+    """
+    Bounded buffer passing data from a producing thread to a consumer.
+    write_at() blocks while the buffer is full, read() blocks until enough
+    data or the end of the stream is available.
+    """
+
+    def __init__(self, size, offset=0):
+        self.size = size
+        self.blocks = []
+        self.length = 0
+        self.offset = offset
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def write_at(self, offset, data):
+        """Append data found at offset of the stream, skipping data already seen."""
+        with self.condition:
+            if offset > self.offset:
+                raise Exception('Gap in stream at byte %d' % self.offset)
+            data = data[self.offset - offset:]
+            while self.length >= self.size and not self.closed:
+                self.condition.wait(1)
+            if self.closed:
+                raise Exception('Stream closed')
+            if data:
+                self.blocks.append(data)
+                self.length += len(data)
+                self.offset += len(data)
+                self.condition.notify_all()
+
+    def close(self, error=None):
+        """Mark the end of the stream, error is re-raised by read()."""
+        with self.condition:
+            self.closed = True
+            self.error = error
+            self.condition.notify_all()
+
+    def read(self, size):
+        with self.condition:
+            # let the writer fill up at least size bytes
+            self.size = max(self.size, size)
+            while self.length < size and not self.closed:
+                self.condition.wait(1)
+            if self.error:
+                raise self.error[0], self.error[1], self.error[2]
+            data = ''.join(self.blocks)
+            self.blocks = [data[size:]] if len(data) > size else []
+            self.length = len(data) - len(data[:size])
+            self.condition.notify_all()
+            return data[:size]
 
 class MultiPartForm(object):
-    """Accumulate the data to be used when posting a form."""
+    """Accumulate the data to be used when posting a form.
+
+    The form is sent as a file-like request body: read() returns the
+    boundaries and headers followed by the data of attached files in
+    BLOCKSIZE blocks, files are never loaded into memory as a whole.
+    """
 
     def __init__(self):
         self.form_fields = []
         self.files = []
         self.boundary = mimetools.choose_boundary()
+        self._blocks = None
+        self._buffer = ''
+        self._pos = 0
         return
     
     def get_content_type(self):
         return 'multipart/form-data; boundary=%s' % self.boundary
 
+    def reset(self):
+        """Start reading the form data from the beginning again."""
+        self._blocks = None
+        self._buffer = ''
+        self._pos = 0
+
     def add_field(self, name, value):
         """Add a simple field to the form data."""
         if isinstance(name, unicode):
@@ -291,86 +1542,368 @@ class MultiPartForm(object):
         self.form_fields.append((name, value))
         return
 
-    def add_file(self, fieldname, filename, fileHandle, mimetype=None):
-        """Add a file to be uploaded."""
+    def add_file(self, fieldname, filename, fileHandle, mimetype=None, length=None):
+        """Add a file to be uploaded.
+
+        fileHandle is either a string or a file object, of which length bytes
+        (by default everything) starting at its current position are sent.
+        """
         if isinstance(fieldname, unicode):
             fieldname = fieldname.encode('utf-8')
         if isinstance(filename, unicode):
             filename = filename.encode('utf-8')
         if hasattr(fileHandle, 'read'):
-            body = fileHandle.read()
+            start = fileHandle.tell()
+            if length is None:
+                fileHandle.seek(0, 2)
+                length = fileHandle.tell() - start
+                fileHandle.seek(start)
+            body = (fileHandle, start, length)
         else:
             body = fileHandle
         if mimetype is None:
             mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
         self.files.append((fieldname, filename, mimetype, body))
         return
-    
+
+    def parts(self):
+        """Yield the form data as strings and (fileHandle, start, length) tuples."""
+        part_boundary = '--' + self.boundary
+        for name, value in self.form_fields:
+            yield '\r\n'.join([
+                part_boundary,
+                'Content-Disposition: form-data; name="%s"' % name,
+                '',
+                value,
+                ''
+            ])
+        for field_name, filename, content_type, body in self.files:
+            yield '\r\n'.join([
+                part_boundary,
+                'Content-Disposition: file; name="%s"; filename="%s"' % \
+                    (field_name, filename),
+                'Content-Type: %s' % content_type,
+                '',
+                ''
+            ])
+            yield body
+            yield '\r\n'
+        yield '--' + self.boundary + '--\r\n'
+
+    def get_content_length(self):
+        length = 0
+        for part in self.parts():
+            if isinstance(part, tuple):
+                length += part[2]
+            else:
+                length += len(part)
+        return length
+
+    def __iter__(self):
+        """Iterate over the form data, file data is read in BLOCKSIZE blocks."""
+        for part in self.parts():
+            if isinstance(part, tuple):
+                fileHandle, start, length = part
+                fileHandle.seek(start)
+                while length > 0:
+                    data = fileHandle.read(min(BLOCKSIZE, length))
+                    if not data:
+                        raise Exception('File ended before %d more bytes could be read' % length)
+                    length -= len(data)
+                    yield data
+            else:
+                yield part
+
+    def read(self, size=-1):
+        """Read up to size bytes of the form data, used as request body."""
+        if self._blocks is None:
+            self._blocks = iter(self)
+        if size < 0:
+            data = self._buffer[self._pos:] + ''.join(self._blocks)
+            self._buffer, self._pos = '', 0
+            return data
+        while self._pos >= len(self._buffer):
+            try:
+                self._buffer, self._pos = self._blocks.next(), 0
+            except StopIteration:
+                return ''
+        data = self._buffer[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
     def __str__(self):
         """Return a string representing the form data, including attached files."""
-        # Build a list of lists, each containing "lines" of the
-        # request.  Each part is separated by a boundary string.
-        # Once the list is built, return a string where each
-        # line is separated by '\r\n'.  
-        parts = []
-        part_boundary = '--' + self.boundary
-        
-        # Add the form fields
-        parts.extend(
-            [ part_boundary,
-              'Content-Disposition: form-data; name="%s"' % name,
-              '',
-              value,
-            ]
-            for name, value in self.form_fields
-            )
-        
-        # Add the files to upload
-        parts.extend(
-            [ part_boundary,
-              'Content-Disposition: file; name="%s"; filename="%s"' % \
-                 (field_name, filename),
-              'Content-Type: %s' % content_type,
-              '',
-              body,
-            ]
-            for field_name, filename, content_type, body in self.files
-            )
-        
-        # Flatten the list and add closing boundary marker,
-        # then return CR+LF separated data
-        flattened = list(itertools.chain(*parts))
-        flattened.append('--' + self.boundary + '--')
-        flattened.append('')
-        return '\r\n'.join(flattened)
+        return ''.join(self)
+
+class ChunkSizer(object):
+    """
+    Size of the next upload chunk, adapted to the measured throughput so that
+    a chunk takes about TARGET_SECONDS to upload, and halved after errors.
+    """
+    TARGET_SECONDS = 10
+
+    def __init__(self, size, minimum, maximum, adaptive=True):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.rate = None
+        self.size = self.clamp(size)
+
+    def clamp(self, size):
+        size = size - size % BLOCKSIZE or BLOCKSIZE
+        return max(self.minimum, min(self.maximum, size))
+
+    def success(self, length, seconds):
+        """Record that length bytes were uploaded in seconds."""
+        if not self.adaptive:
+            return
+        rate = length / max(seconds, 0.001)
+        self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+        self.size = self.clamp(min(self.size * 2, int(self.rate * self.TARGET_SECONDS)))
+
+    def failure(self):
+        if self.adaptive:
+            self.size = self.clamp(self.size // 2)
+
+class StashExpired(Exception):
+    """Continuing an interrupted upload failed, the stashed chunks are gone."""
+
+class PermanentError(Exception):
+    """The import can not succeed, trying it again would fail the same way."""
+
+def private_directory(parent, name):
+    '''
+    Return the directory name in parent, created if needed so that only the
+    current user can access it. Returns None if it is not owned by and
+    private to the current user.
+    '''
+    path = os.path.join(parent, name)
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            return None
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 077:
+        return None
+    return path
+
+class RateLimiter(object):
+    """
+    Token bucket for the API requests to a wiki, shared by all threads and,
+    if filename is set, by all processes of the host that use the same file.
+
+    The rate starts at rate requests per second. It is halved, and all
+    requests wait, when the wiki asks to slow down. After successful
+    requests it is raised again, up to rate.
+    """
+    MIN_RATE = 0.1
+    # longest pause a state file may ask for
+    MAX_PAUSE = 300
+
+    def __init__(self, rate, filename=None):
+        self.rate = rate
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.local_state = self.initial()
+
+    def initial(self):
+        return {'rate': self.rate, 'tokens': 1.0, 'time': time.time(), 'paused_until': 0}
+
+    def load(self, f):
+        """Read the bucket from f, kept within bounds, as any process may have written it."""
+        now = time.time()
+        try:
+            state = json.load(f)
+            rate = min(max(float(state['rate']), self.MIN_RATE), self.rate)
+            return {
+                'rate': rate,
+                'tokens': min(max(float(state['tokens']), 0), max(rate, 1)),
+                'time': min(float(state['time']), now),
+                'paused_until': min(float(state['paused_until']), now + self.MAX_PAUSE)
+            }
+        except (ValueError, KeyError, TypeError):
+            return self.initial()
+
+    @contextmanager
+    def state(self):
+        """The bucket, locked against other threads and processes while in use."""
+        with self.lock:
+            if not self.filename:
+                yield self.local_state
+                return
+            with open(self.filename, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    state = self.load(f)
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self):
+        """Wait until a request may be sent."""
+        while True:
+            with self.state() as state:
+                now = time.time()
+                rate = min(state['rate'], self.rate)
+                state['tokens'] = min(max(rate, 1), state['tokens'] + (now - state['time']) * rate)
+                state['time'] = now
+                wait = state['paused_until'] - now
+                if wait <= 0:
+                    if state['tokens'] >= 1:
+                        state['tokens'] -= 1
+                        return
+                    wait = (1 - state['tokens']) / rate
+            time.sleep(wait)
+
+    def success(self):
+        with self.state() as state:
+            state['rate'] = min(self.rate, state['rate'] + self.rate / 20.0)
+
+    def backoff(self, seconds):
+        """Halve the rate and let no request through for seconds."""
+        with self.state() as state:
+            state['rate'] = max(self.MIN_RATE, state['rate'] / 2)
+            state['paused_until'] = max(state['paused_until'], time.time() + seconds)
+            state['tokens'] = 0
 
 class Mediawiki(object):
+    # API errors after which the session is renewed and the request repeated
+    SESSION_ERRORS = ('assertuserfailed', 'badtoken', 'notloggedin')
+    # API errors asking to slow down, the request is repeated later
+    THROTTLE_ERRORS = ('maxlag', 'ratelimited')
+    # API errors after which an upload chunk is sent again
+    TRANSIENT_ERRORS = ('backend-fail-internal', 'internal_api_error', 'ratelimited', 'readonly')
+
     def __init__(self, url, username, password):
         self.url = url
         self.username = username
         self.password = password
+        self.tokens = {}
+        self.site = None
+        # held while the session is renewed or saved
+        self.session_lock = threading.RLock()
+        self.session_generation = 0
 
-        self.cj = cookielib.CookieJar()
-        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cj),
-                                           urllib2.HTTPHandler(debuglevel=0))
+        if SESSION_CACHE:
+            # cookies and tokens are reused by later runs for this wiki and user
+            key = hashlib.sha1('%s\n%s' % (url, username)).hexdigest()
+            self.session_file = os.path.join(SESSION_CACHE, key)
+            self.cj = cookielib.LWPCookieJar(self.session_file + '.cookies')
+        else:
+            self.session_file = None
+            self.cj = cookielib.CookieJar()
+        self.opener = build_opener(urllib2.HTTPCookieProcessor(self.cj))
         self.opener.addheaders = [
             ('User-Agent', USER_AGENT)
         ]
+        # bounds concurrent uploads if shared between threads
+        self.upload_slots = threading.BoundedSemaphore(MAX_UPLOADS)
+        rate_file = None
+        if RATE_LIMIT_DIR and fcntl:
+            # shared with the other importers of this user for the wiki, in a
+            # directory other users can not write to
+            directory = private_directory(RATE_LIMIT_DIR, 'youtube2mediawiki-%d' % os.getuid())
+            if directory:
+                rate_file = os.path.join(directory, '%s.rate' % hashlib.sha1(url).hexdigest()[:16])
+            elif DEBUG:
+                print 'Not sharing the rate limit, %s is not private' % RATE_LIMIT_DIR
+        self.limiter = RateLimiter(API_RATE, rate_file)
+        if not self.load_session():
+            self.start_session()
+
+    def load_session(self):
+        """Load cookies and tokens cached by a previous run, if any."""
+        if not self.session_file or not os.path.exists(self.session_file + '.cookies'):
+            return False
+        try:
+            self.cj.load(ignore_discard=True)
+            with open(self.session_file + '.json') as f:
+                self.tokens = json.load(f)
+        except (IOError, ValueError, cookielib.LoadError):
+            return False
+        return True
+
+    def save_session(self):
+        if not self.session_file:
+            return
+        with self.session_lock:
+            if not os.path.exists(SESSION_CACHE):
+                os.makedirs(SESSION_CACHE, 0700)
+            # written to temporary files first, so that readers never see half a file
+            tmp = '.%d.tmp' % os.getpid()
+            self.cj.save(self.session_file + '.cookies' + tmp, ignore_discard=True)
+            with open(self.session_file + '.json' + tmp, 'w') as f:
+                json.dump(dict(self.tokens), f)
+            for ext in ('.cookies', '.json'):
+                os.chmod(self.session_file + ext + tmp, 0600)
+                os.rename(self.session_file + ext + tmp, self.session_file + ext)
+
+    def start_session(self):
         r = self.login()
         if not r['login']['result'] == 'Success':
             if DEBUG:
                 print r
             raise Exception('login failed')
+        self.tokens = {}
+        self.session_generation += 1
+        self.save_session()
+
+    def renew_session(self, generation):
+        """Log in again, unless another thread did so since generation."""
+        with self.session_lock:
+            if generation == self.session_generation:
+                if DEBUG:
+                    print 'Session expired, logging in again'
+                self.start_session()
 
     def post(self, form):
+        """
+        POST form to the API when the rate limiter lets it through, and
+        repeat it as long as the wiki asks to slow down, up to
+        THROTTLE_RETRIES times.
+        """
+        for retry in xrange(THROTTLE_RETRIES + 1):
+            if retry:
+                form.reset()
+            self.limiter.acquire()
+            r, retry_after = self.send(form)
+            error = r.get('error', {})
+            throttled = error.get('code') in self.THROTTLE_ERRORS or \
+                (retry_after is not None and r.get('status', {}).get('code') in (429, 503))
+            if not throttled:
+                self.limiter.success()
+                return r
+            if retry == THROTTLE_RETRIES:
+                return r
+            delay = retry_after or error.get('lag') or min(2 ** retry, 60)
+            if DEBUG:
+                print 'Wiki asks to slow down (%s), waiting %s seconds' % (
+                    error.get('code') or r['status']['code'], delay)
+            METRICS.count('retries', kind='throttle')
+            self.limiter.backoff(min(float(delay), 300))
+
+    def send(self, form):
+        """POST form, returns the result and the Retry-After header as a number, if any."""
+        def retry_after(headers):
+            try:
+                return int(headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                return None
         try:
             request = urllib2.Request(self.url)
-            body = str(form)
             request.add_header('Content-type', form.get_content_type())
-            request.add_header('Content-length', len(body))
-            request.add_data(body)
-            result = self.opener.open(request).read().strip()
-            return json.loads(result)
+            request.add_header('Content-length', str(form.get_content_length()))
+            request.add_data(form)
+            u = self.opener.open(request)
+            result = json.load(u)
+            u.close()
+            return result, retry_after(u.info())
         except urllib2.HTTPError, e:
             if DEBUG:
                 if e.code >= 500:
@@ -382,22 +1915,50 @@ class Mediawiki(object):
                 result = json.loads(result)
             except:
                 result = {'status':{}}
+            result.setdefault('status', {})
             result['status']['code'] = e.code
             result['status']['text'] = str(e)
-            return result
+            return result, retry_after(e.info())
 
     def api(self, action, data={}, files={}):
+        if action == 'login':
+            return self.post(self.api_form(action, data, files))
+        generation = self.session_generation
+        positions = dict((key, files[key][0].tell()) for key in files if isinstance(files[key], tuple))
+        METRICS.count('wiki_requests', action=action)
+        r = self.post(self.api_form(action, data, files))
+        if r.get('error', {}).get('code') in self.SESSION_ERRORS:
+            METRICS.count('retries', kind='session')
+            if r['error']['code'] != 'badtoken' or data.get('token') in (None, self.tokens.get('edit')):
+                self.renew_session(generation)
+            # else the token is from a session renewed since, the current one is sent
+            data = dict(data)
+            if 'token' in data:
+                data['token'] = self.edit_token()
+            for key in positions:
+                files[key][0].seek(positions[key])
+            r = self.post(self.api_form(action, data, files))
+        return r
+
+    def api_form(self, action, data, files):
         form = MultiPartForm()
         form.add_field('format', 'json')
         form.add_field('action', action)
+        if MAXLAG:
+            form.add_field('maxlag', str(MAXLAG))
+        if action != 'login':
+            form.add_field('assert', 'user')
         for key in data:
             form.add_field(key, data[key])
         for key in files:
             if isinstance(files[key], basestring):
                 form.add_file(key, os.path.basename(files[key]), open(files[key]))
+            elif isinstance(files[key], tuple):
+                fileHandle, length = files[key]
+                form.add_file(key, 'data.bin', fileHandle, length=length)
             else:
                 form.add_file(key, 'data.bin', files[key])
-        return self.post(form)
+        return form
 
     def login(self):
         form = MultiPartForm()
@@ -420,101 +1981,598 @@ class Mediawiki(object):
             'titles': page,
             'intoken': intoken
         })['query']['pages']
+        self.tokens[intoken] = str(r.values()[0][intoken + 'token'])
+        self.save_session()
         return '-1' in r and str(r['-1']['edittoken']) or \
                OVERWRITE and str(r.items()[0][1]['edittoken']) or \
                None
 
-    def upload(self, filename, description, text, name=''):
-        CHUNKSIZE = 5*1024*1024
-        offset = 0
-        fn = name or os.path.basename(filename)
-        pagename = 'File:' + fn.replace(' ', '_')
-        token = self.get_token(pagename, 'edit')
-        if not token:
-            raise Exception("%s exists, can not upload" % pagename)
-        chunk = StringIO()
-        filesize = os.stat(filename).st_size
-        f = open(filename)
-        f.seek(offset)
-        chunk.write(f.read(CHUNKSIZE))
-        f.close()
-        chunk.seek(0)
-        #Upload first chunk and get filekey for further chunks
-        args_upload = {
-            'comment': description,
-            'filename': fn,
-            'filesize': str(filesize),
-            'offset': str(offset),
-            'token': token
-        }
-        if IGNORE_WARNINGS:
-            args_upload['ignorewarnings'] = ''
-        r = self.api('upload', args_upload, {'chunk': chunk})
-        offset += CHUNKSIZE
-        if 'error' in r:
+    def check_upload(self, r):
+        if 'error' in r or r.get('status', {}).get('code', 200) != 200 or \
+            'error' in r.get('upload', {}):
             if DEBUG:
-                if 'info' in r['error']:
+                if 'info' in r.get('error', {}):
                     print r['error']['info']
                 else:
-                    print r['error']
+                    print r
             raise Exception("Upload error") # return r
-        filekey = r['upload']['filekey']
-        while offset < filesize:
+
+    def is_transient(self, r):
+        """Whether the error in the API response r may go away by retrying."""
+        code = r.get('error', {}).get('code', '')
+        return r.get('status', {}).get('code', 200) >= 500 or code.startswith(self.TRANSIENT_ERRORS)
+
+    def stashed_offset(self, r):
+        """
+        The offset the stash expects the next chunk at if r rejected a chunk
+        sent at another offset, None otherwise.
+        """
+        error = r.get('error', {})
+        if error.get('code') != 'stashfailed':
+            return None
+        if 'offset' in error:
+            return int(error['offset'])
+        match = re.search(r'expected (\d+)', error.get('info', ''))
+        return match and int(match.group(1))
+
+    def siteinfo(self):
+        """General information about the wiki, i.e. its upload limits."""
+        if self.site is None:
+            r = self.api('query', {'meta': 'siteinfo', 'siprop': 'general'})
+            self.site = r.get('query', {}).get('general', {})
+        return self.site
+
+    def chunk_sizer(self):
+        """A ChunkSizer kept within the chunk sizes the wiki accepts."""
+        site = self.siteinfo()
+        maximum = min(MAX_CHUNKSIZE, int(site.get('maxuploadsize') or MAX_CHUNKSIZE))
+        minimum = min(max(MIN_CHUNKSIZE, int(site.get('minuploadchunksize') or 0)), maximum)
+        return ChunkSizer(CHUNKSIZE, minimum, maximum, ADAPTIVE_CHUNKS)
+
+    def wait_for_stash(self, filekey, token):
+        """Poll the status of an upload queued with async=1 until it is done."""
+        delay = 1
+        while True:
+            r = self.api('upload', {
+                'checkstatus': '1',
+                'filekey': filekey,
+                'token': token
+            })
+            self.check_upload(r)
+            if r['upload'].get('result') != 'Poll':
+                return r
             if DEBUG:
-                print r
-            if 'error' in r or r.get('status', {}).get('code', 200) != 200 or \
-                'error' in r.get('upload', {}):
-                raise Exception("Upload error") # return r
-            chunk = StringIO()
-            f = open(filename)
-            f.seek(offset)
-            chunk.write(f.read(CHUNKSIZE))
-            f.close()
-            chunk.seek(0)
-            #Upload chunk at offset
+                print 'Waiting for', r['upload'].get('stage', 'upload')
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def upload(self, filename, description, text, name='', token=None, resume=None, progress=None):
+        fn = name or os.path.basename(filename)
+        filesize = os.stat(filename).st_size
+        sizer = self.chunk_sizer()
+        def offsets():
+            offset = resume[1] if resume else 0
+            while offset < max(filesize, 1):
+                length = min(sizer.size, filesize - offset)
+                yield offset, length
+                # an empty file is sent as one empty chunk
+                offset += length or 1
+        def file_chunks(f, offsets):
+            # Chunks are sent as slices of the open file
+            for offset, length in offsets:
+                f.seek(offset)
+                yield offset, (f, length)
+        def read_chunks():
+            # Chunks are read in a background thread while the previous
+            # chunk is in flight, sending them then reads from the page
+            # cache. Only one block at a time is held in memory.
+            with open(filename, 'rb') as f:
+                for offset, length in offsets():
+                    f.seek(offset)
+                    remaining = length
+                    while remaining > 0 and f.read(min(BLOCKSIZE, remaining)):
+                        remaining -= BLOCKSIZE
+                    yield offset, length
+        with open(filename, 'rb') as f:
+            if PIPELINE_UPLOAD:
+                chunks = readahead(read_chunks(), UPLOAD_READAHEAD)
+            else:
+                chunks = offsets()
+            try:
+                return self.upload_chunks(file_chunks(f, chunks), filesize, description, text, fn,
+                                          token, resume, progress, sizer)
+            except StashExpired:
+                if DEBUG:
+                    print 'Can not resume upload, starting over'
+            finally:
+                # stop reading ahead before f is closed
+                chunks.close()
+        return self.upload(filename, description, text, name, token, None, progress)
+
+    def upload_stream(self, stream, filesize, description, text, name, token=None,
+                      resume=None, progress=None):
+        """
+        Upload filesize bytes read from stream, i.e. a StreamBuffer. When
+        resuming, stream has to start at the offset to resume at.
+        """
+        sizer = self.chunk_sizer()
+        def stream_chunks():
+            offset = resume[1] if resume else 0
+            while offset < max(filesize, 1):
+                length = min(sizer.size, filesize - offset)
+                data = stream.read(length)
+                if len(data) < length:
+                    raise Exception('Stream ended at byte %d of %d' % (offset + len(data), filesize))
+                yield offset, (StringIO(data), len(data))
+                offset += length or 1
+        return self.upload_chunks(stream_chunks(), filesize, description, text, name, token,
+                                  resume, progress, sizer)
+
+    def upload_chunks(self, chunks, filesize, description, text, fn, token=None,
+                      resume=None, progress=None, sizer=None):
+        """
+        Upload (offset, chunk) pairs from chunks to the stash and publish them
+        as fn. Without a token, the existence of fn is checked first.
+
+        resume is the (filekey, offset) of an interrupted upload to continue,
+        raises StashExpired if the wiki does not accept it. progress is called
+        with filekey and the offset of the next chunk after each chunk.
+
+        Chunks failing with a transient error are sent again, up to
+        UPLOAD_RETRIES times. sizer is told how long each chunk took.
+        """
+        pagename = 'File:' + fn.replace(' ', '_')
+        if not token:
+            token = self.get_token(pagename, 'edit')
+        if not token:
+            raise PermanentError("%s exists, can not upload" % pagename)
+        filekey = resume[0] if resume else None
+        r = None
+        session = [self.session_generation, token]
+        def current_token():
+            # a renewed session has new tokens, the old ones are rejected
+            if self.session_generation != session[0]:
+                session[:] = [self.session_generation, self.edit_token()]
+            return session[1]
+        for offset, chunk in chunks:
+            #Upload chunk at offset, the first chunk returns the filekey
+            #for further chunks
             args_upload = {
                 'filename': fn,
                 'filesize': str(filesize),
-                'offset': str(offset),
-                'filekey': filekey,
-                'token': token
+                'offset': str(offset)
             }
+            if filekey:
+                args_upload['filekey'] = filekey
+            else:
+                args_upload['comment'] = description
+            if PIPELINE_UPLOAD and offset + chunk[1] >= filesize:
+                # assemble the chunks in the background
+                args_upload['async'] = '1'
             if IGNORE_WARNINGS:
                 args_upload['ignorewarnings'] = ''
-            r = self.api('upload', args_upload, {'chunk': chunk})
-            if filekey != r['upload']['filekey']:
+            position = chunk[0].tell()
+            for retry in xrange(UPLOAD_RETRIES + 1):
+                if retry:
+                    METRICS.count('retries', kind='upload')
+                    if sizer:
+                        sizer.failure()
+                    if DEBUG:
+                        print 'Retrying chunk at offset %d' % offset
+                    time.sleep(min(2 ** retry, 60))
+                    chunk[0].seek(position)
+                args_upload['token'] = current_token()
+                started = time.time()
+                try:
+                    r = self.api('upload', args_upload, {'chunk': chunk})
+                except (IOError, httplib.HTTPException), e:
+                    if retry == UPLOAD_RETRIES:
+                        raise
+                    if DEBUG:
+                        print 'Chunk upload failed:', e
+                    continue
+                if retry and filekey and self.stashed_offset(r) == offset + chunk[1]:
+                    # the chunk was stored before, only the response got lost
+                    result = 'Continue'
+                    if offset + chunk[1] >= filesize:
+                        result = 'Poll' if PIPELINE_UPLOAD else 'Success'
+                    r = {'upload': {'result': result, 'filekey': filekey, 'offset': offset + chunk[1]}}
+                    break
+                if not self.is_transient(r):
+                    break
+            seconds = time.time() - started
+            METRICS.observe('chunk_upload_seconds', seconds)
+            METRICS.event('chunk', offset=offset, bytes=chunk[1], seconds=seconds, retries=retry)
+            if sizer and 'upload' in r:
+                sizer.success(chunk[1], seconds)
+            if DEBUG:
+                print r
+            if resume:
+                try:
+                    self.check_upload(r)
+                except Exception:
+                    raise StashExpired(filekey)
+                resume = None
+            self.check_upload(r)
+            if filekey and filekey != r['upload']['filekey']:
                 if DEBUG:
                     print 'WARNING: filekey changed:', filekey , r['upload']['filekey']
-                filekey = r['upload']['filekey']
-
-            offset += CHUNKSIZE
-        #Finalize upload and move out of stash
-        args_upload = {
-            'filename': fn,
-            'filekey': filekey,
-            'token': token,
-            'text': text,
-            'comment': description
-        }
-        if IGNORE_WARNINGS:
-            args_upload['ignorewarnings'] = ''
-        r = self.api('upload', args_upload)
-        if DEBUG:
-            print r
-        if r and r.get('upload', {}).get('result') == 'Success':
-            result_url = r['upload']['imageinfo']['descriptionurl']
-            return result_url
-        else:
-            raise Exception("Upload error during finalize")
+            filekey = r['upload']['filekey']
+            METRICS.count('upload_bytes', chunk[1])
+            if progress:
+                progress(filekey, offset + chunk[1])
+        with METRICS.phase('finalize'):
+            if (r and r['upload'].get('result') == 'Poll') or (not r and PIPELINE_UPLOAD):
+                self.wait_for_stash(filekey, current_token())
+            #Finalize upload and move out of stash
+            args_upload = {
+                'filename': fn,
+                'filekey': filekey,
+                'token': current_token(),
+                'text': text,
+                'comment': description
+            }
+            if PIPELINE_UPLOAD:
+                args_upload['async'] = '1'
+            if IGNORE_WARNINGS:
+                args_upload['ignorewarnings'] = ''
+            r = self.api('upload', args_upload)
+            if DEBUG:
+                print r
+            if r and r.get('upload', {}).get('result') == 'Poll':
+                r = self.wait_for_stash(filekey, current_token())
+            if r and r.get('upload', {}).get('result') == 'Success':
+                result_url = r['upload']['imageinfo']['descriptionurl']
+                return result_url
+            else:
+                raise Exception("Upload error during finalize")
+
+    def pages_exist(self, titles):
+        """
+        Return a dict telling for each of titles whether the page exists,
+        querying up to 50 titles at a time.
+        """
+        exists = {}
+        for i in xrange(0, len(titles), 50):
+            batch = titles[i:i + 50]
+            r = self.api('query', {
+                'prop': 'info',
+                'titles': '|'.join(batch),
+                'intoken': 'edit'
+            })['query']
+            normalized = dict((n['from'], n['to']) for n in r.get('normalized', []))
+            pages = dict((p['title'], 'missing' not in p and 'invalid' not in p)
+                         for p in r['pages'].values())
+            for title in batch:
+                exists[title] = pages.get(normalized.get(title, title), False)
+            self.tokens['edit'] = str(r['pages'].values()[0]['edittoken'])
+        self.save_session()
+        return exists
+
+    def find_duplicates(self, sha1):
+        """Return the files on the wiki with the SHA-1 sha1."""
+        r = self.api('query', {
+            'list': 'allimages',
+            'aisha1': sha1,
+            'aiprop': 'url'
+        })
+        return r.get('query', {}).get('allimages', [])
+
+    def edit_token(self, page='Main Page'):
+        """Return the cached edit token, querying it via page if there is none."""
+        if 'edit' not in self.tokens:
+            self.get_token(page, 'edit')
+        return self.tokens['edit']
 
     def edit_page(self, pagename, text, comment=''):
-        token = self.get_token(pagename, 'edit')
-        return self.api('edit', {
+        data = {
             'comment': comment,
             'text': text,
             'title': pagename,
-            'token': token
-        })
+            'token': self.edit_token(pagename)
+        }
+        if not OVERWRITE:
+            # existing pages are left alone
+            data['createonly'] = '1'
+        return self.api('edit', data)
+
+    def edit_pages(self, pages, comment=''):
+        """Save (pagename, text) pairs with up to EDIT_THREADS concurrent edits."""
+        if not pages:
+            return []
+        self.edit_token()
+        return pmap(lambda page: self.edit_page(page[0], page[1], comment), pages, EDIT_THREADS)
+
+class JobStore(object):
+    '''
+    SQLite database recording how far the import of each video to a wiki
+    got, so that an interrupted import continues where it stopped. Imports
+    that can not succeed are recorded in the phase failed with their error
+    and start over when tried again.
+    '''
+    PHASES = ['metadata', 'downloaded', 'merged', 'stashed', 'finalized', 'done']
+    FIELDS = ['phase', 'workdir', 'info', 'name', 'sha1', 'filekey', 'offset', 'result_url', 'error']
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            youtube_id TEXT,
+            wiki TEXT,
+            phase TEXT,
+            workdir TEXT,
+            info TEXT,
+            name TEXT,
+            sha1 TEXT,
+            filekey TEXT,
+            offset INTEGER,
+            result_url TEXT,
+            updated REAL,
+            error TEXT,
+            PRIMARY KEY (youtube_id, wiki)
+        )''')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(jobs)')]
+        if 'error' not in columns:
+            # written by an earlier version
+            self.db.execute('ALTER TABLE jobs ADD COLUMN error TEXT')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def get(self, youtube_id, wiki):
+        row = self.db.execute('SELECT %s FROM jobs WHERE youtube_id = ? AND wiki = ?' % ', '.join(self.FIELDS),
+                              (youtube_id, wiki)).fetchone()
+        if not row:
+            return {}
+        job = dict(zip(self.FIELDS, row))
+        job['info'] = job['info'] and json.loads(job['info'])
+        return job
+
+    def update(self, youtube_id, wiki, **fields):
+        job = self.get(youtube_id, wiki)
+        job.update(fields)
+        values = [job.get(key) for key in self.FIELDS]
+        values[self.FIELDS.index('info')] = job.get('info') and json.dumps(job['info'])
+        self.db.execute('INSERT OR REPLACE INTO jobs (youtube_id, wiki, %s, updated) VALUES (?, ?, %s, ?)' % (
+                        ', '.join(self.FIELDS), ', '.join('?' * len(self.FIELDS))),
+                        [youtube_id, wiki] + values + [time.time()])
+        self.db.commit()
+
+    def reached(self, job, phase):
+        """Whether job got to phase."""
+        return job.get('phase') in self.PHASES and \
+            self.PHASES.index(job['phase']) >= self.PHASES.index(phase)
+
+class Workspace(object):
+    '''
+    Temporary directories for imports within a byte budget. directories are
+    tried in order, for example a tmpfs first and a disk to spill to, budget
+    bounds the bytes reserved in all of them together. An import reserves
+    the space it is estimated to need before it downloads and waits while
+    the other imports hold too much of it, so that the number of concurrent
+    imports is bounded by disk space.
+    '''
+
+    def __init__(self, directories=None, budget=None):
+        self.directories = directories or [tempfile.gettempdir()]
+        self.budget = budget
+        self.reservations = []
+        self.waiting = []
+        self.lock = threading.Condition()
+
+    def capacity(self, directory):
+        """Return the total and free bytes of the file system of directory."""
+        if not hasattr(os, 'statvfs'):
+            return None, None
+        st = os.statvfs(directory)
+        return st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize
+
+    def available(self, directory):
+        """Bytes in directory that are neither used nor reserved by any import."""
+        total, free = self.capacity(directory)
+        if free is None:
+            return None
+        for space in self.reservations:
+            if os.path.dirname(space.path) == directory:
+                # written files are part of the reservation, not in free
+                free += space.used - max(space.size, space.used)
+        return free
+
+    def admit(self, size, path=None, used=0):
+        """Reserve size bytes for a new Reservation, None if they are not free."""
+        reserved = sum(max(space.size, space.used) for space in self.reservations)
+        if self.budget and reserved + size > self.budget:
+            return None
+        directories = [os.path.dirname(path)] if path else self.directories
+        for directory in directories:
+            available = self.available(directory)
+            if available is None or available >= size:
+                space = Reservation(self, path or tempfile.mkdtemp(dir=directory), size, used)
+                self.reservations.append(space)
+                return space
+        return None
+
+    def check(self, size):
+        """Raise an exception if size bytes would never fit."""
+        if self.budget and size > self.budget:
+            raise Exception('%.1f MB needed, more than the workspace budget of %.1f MB' % (
+                size / 1048576.0, self.budget / 1048576.0))
+        totals = [self.capacity(directory)[0] for directory in self.directories]
+        if not self.reservations or None not in totals and size > max(totals):
+            raise Exception('%.1f MB needed, not enough space in %s' % (
+                size / 1048576.0, ', '.join(self.directories)))
+
+    def reserve(self, size, path=None, block=True):
+        """
+        Return a Reservation of size bytes, in path if given or else in a new
+        directory. Waits until other imports released enough space, without
+        block returns None instead.
+        """
+        # files left in path by an interrupted import count as written
+        used = directory_size(path) if path else 0
+        with self.lock:
+            while True:
+                space = self.admit(size, path, used)
+                if space:
+                    return space
+                self.check(size)
+                if not block:
+                    return None
+                # wait in steps, so that KeyboardInterrupt gets through
+                self.lock.wait(1)
+
+    def changed(self):
+        """Return a Future that is done once space is released."""
+        future = Future()
+        with self.lock:
+            self.waiting.append(future)
+        return future
+
+    def account(self, space, written):
+        """Add written bytes to the files of space."""
+        with self.lock:
+            space.used += written
+
+    def release(self, space, size, written=0):
+        with self.lock:
+            space.size -= size
+            space.used -= written
+            if not space.size and space.closed:
+                self.reservations.remove(space)
+            self.lock.notify_all()
+            waiting, self.waiting = self.waiting, []
+        for future in waiting:
+            future.set_result(None)
+
+class Reservation(object):
+    '''Directory of an import and the bytes reserved for it in a Workspace.'''
+
+    def __init__(self, workspace, path, size, used=0):
+        self.workspace = workspace
+        self.path = path
+        self.size = size
+        # bytes of the files written to the directory so far
+        self.used = used
+        self.closed = False
+
+    def written(self, *filenames):
+        """Account for filenames, complete downloads in the directory."""
+        self.workspace.account(self, sum(file_size(filename) for filename in filenames))
+
+    def discard(self, *filenames):
+        """Delete filenames, intermediates that are not needed any more."""
+        size = 0
+        for filename in filenames:
+            if os.path.exists(filename):
+                size += os.path.getsize(filename)
+                os.unlink(filename)
+        self.workspace.release(self, min(size, self.size), min(size, self.used))
+
+    def close(self, remove=True):
+        """Release the reservation, removing the directory with remove."""
+        if remove:
+            shutil.rmtree(self.path, True)
+        self.closed = True
+        self.workspace.release(self, self.size, self.used)
+
+WORKSPACE = Workspace()
+
+def file_size(filename):
+    """Return the size of filename, 0 if it does not exist."""
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+def directory_size(path):
+    """Return the bytes of the files in path."""
+    return sum(file_size(os.path.join(root, name))
+               for root, dirs, files in os.walk(path) for name in files)
+
+def workspace_size(yt, youtube_id, max_size=None):
+    '''
+    Return the bytes an import of youtube_id needs in its workspace: the
+    video, with MERGE_DASH the merged file and, unless merged while
+    downloading, also the video and audio streams. If YouTube does not tell
+    the size, the largest download of at most max_size is assumed, bounded
+    by the budget of WORKSPACE.
+    '''
+    size = yt.download_size(youtube_id, max_size)
+    known = size is not None
+    if not known:
+        size = max_size or 0
+    if MERGE_DASH and not STREAM_MERGE:
+        size *= 2
+    if not known and WORKSPACE.budget:
+        # wait for the whole budget at most, more would never be admitted
+        size = min(size or WORKSPACE.budget, WORKSPACE.budget)
+    return size
+
+class ImportIndex(object):
+    '''
+    SQLite database of the videos imported into each wiki: the name and url
+    of the file, its SHA-1, when it was uploaded, the caption languages imported
+    and when the feed entry of the video was updated. Later imports and
+    syncs skip what is in it without asking YouTube or the wiki.
+    '''
+    FIELDS = ['name', 'url', 'sha1', 'uploaded', 'languages', 'updated']
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS videos (
+            youtube_id TEXT,
+            wiki TEXT,
+            name TEXT,
+            url TEXT,
+            sha1 TEXT,
+            uploaded REAL,
+            languages TEXT,
+            updated TEXT,
+            PRIMARY KEY (youtube_id, wiki)
+        )''')
+        self.db.commit()
+
+    def row(self, row):
+        video = dict(zip(self.FIELDS, row))
+        video['languages'] = json.loads(video['languages'] or '[]')
+        return video
+
+    def get(self, youtube_id, wiki):
+        row = self.db.execute('SELECT %s FROM videos WHERE youtube_id = ? AND wiki = ?' % ', '.join(self.FIELDS),
+                              (youtube_id, wiki)).fetchone()
+        return self.row(row) if row else {}
+
+    def videos(self, wiki):
+        """Return the videos imported into wiki, by YouTube id."""
+        return dict((row[0], self.row(row[1:])) for row in self.db.execute(
+            'SELECT youtube_id, %s FROM videos WHERE wiki = ?' % ', '.join(self.FIELDS), (wiki,)))
+
+    def update(self, youtube_id, wiki, **fields):
+        video = self.get(youtube_id, wiki)
+        video.update(fields)
+        values = [video.get(key) for key in self.FIELDS]
+        values[self.FIELDS.index('languages')] = json.dumps(sorted(video.get('languages') or []))
+        self.db.execute('INSERT OR REPLACE INTO videos (youtube_id, wiki, %s) VALUES (?, ?, %s)' % (
+                        ', '.join(self.FIELDS), ', '.join('?' * len(self.FIELDS))),
+                        [youtube_id, wiki] + values)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def indexed(youtube_id, wiki):
+    '''Return the url of youtube_id in wiki, an api url, if INDEX has it.'''
+    if INDEX and not OVERWRITE:
+        with closing(ImportIndex(INDEX)) as index:
+            return index.get(youtube_id, wiki).get('url')
+
+def index_import(youtube_id, wiki, yt, name, url, sha1, languages):
+    '''Record the import of youtube_id into wiki, an api url, in INDEX.'''
+    if INDEX:
+        with closing(ImportIndex(INDEX)) as index:
+            index.update(youtube_id, wiki, name=name, url=url, sha1=sha1 or None,
+                         uploaded=time.time(), languages=languages,
+                         updated=yt.listed.get(youtube_id))
 
 def safe_name(s):
     s = s.strip()
@@ -547,45 +2605,823 @@ def ffmpeg_installed():
         print 'Install ffmpeg or place ' + ffmpeg + ' in the current working directory (' + os.getcwd() + ')'
     raise Exception("ffmpeg not found")
 
-def import_youtube(youtube_id, username, password, mediawiki_url, name=''):
+def start_ffmpeg(ffmpeg, video, audio, filename):
+    """
+    Start ffmpeg copying video and audio into filename. Returns the process
+    and the temporary file its output is logged to.
+    """
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen([ffmpeg, '-nostdin', '-y', '-i', video, '-i', audio,
+                                '-c:v', 'copy', '-c:a', 'copy', filename],
+                               stdin=open(os.devnull, 'rb'), stdout=log, stderr=subprocess.STDOUT)
+    return process, log
+
+def check_ffmpeg(process, log):
+    """Wait for ffmpeg to finish, raise an exception with its last messages if it failed."""
+    if process.wait() != 0:
+        log.seek(0)
+        messages = log.read().strip().splitlines()[-10:]
+        raise Exception('merge by ffmpeg failed:\n' + '\n'.join(messages))
+
+def open_fifo(path, process):
+    """Open the named pipe path for writing, once process opened it for reading."""
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError, e:
+            if e.errno != errno.ENXIO:
+                raise
+            if process.poll() is not None:
+                raise Exception('ffmpeg exited before reading %s' % path)
+            time.sleep(0.1)
+            continue
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return os.fdopen(fd, 'wb', 0)
+
+def import_youtube(youtube_id, username, password, mediawiki_url, name='', wiki=None, yt=None):
+    '''Import youtube_id, recording the outcome and its phases in METRICS.'''
+    started = time.time()
+    with METRICS.job(youtube_id):
+        try:
+            result_url = import_video(youtube_id, username, password, mediawiki_url, name, wiki, yt)
+        except Exception, e:
+            METRICS.count('imports', status='error')
+            METRICS.event('import', status='error', error=unicode(e), seconds=time.time() - started)
+            raise
+        finally:
+            METRICS.write()
+        METRICS.count('imports', status='ok')
+        METRICS.event('import', status='ok', url=result_url, seconds=time.time() - started)
+    return result_url
+
+def file_name(name):
+    '''Return name without File: prefix and with a .webm extension.'''
     if len(name) > 0:
         name = re.sub(re.compile('^File:', re.IGNORECASE), '', name)
         name = re.sub(re.compile('\.webm$', re.IGNORECASE), '', name) + '.webm'
-    yt = Youtube()
+    return name
+
+def import_plan(info, name=''):
+    '''
+    Return the name of the file on the wiki, the upload comment and the
+    text of the file page for the video with info, named name or by its
+    title.
+    '''
+    fn = name or u"%s.webm" % safe_name(info['title'])
+    new_version = 'new version ' if OVERWRITE else ''
+    comment = 'Imported %sfrom %s using youtube2mediawiki version %s '%(new_version, info['url'], __version__)
+    return fn, comment, DESCRIPTION % info
+
+def subtitle_pages(fn, languages):
+    '''Return the names of the subtitle pages of the file fn by language.'''
+    return dict((lang, u'TimedText:%s.%s.srt' % (fn.replace(' ', '_'), lang))
+                for lang in languages)
+
+def dedupe(wiki, sha1):
+    '''
+    Return the name and url of a file on wiki with the SHA-1 sha1, None if
+    there is none or DEDUPE is off.
+    '''
+    if not DEDUPE or OVERWRITE or not sha1:
+        return None
+    with METRICS.phase('dedupe'):
+        duplicates = wiki.find_duplicates(sha1)
+    if not duplicates:
+        return None
+    print duplicates[0]['name'], 'is already on the wiki'
+    return duplicates[0]['name'], duplicates[0]['descriptionurl']
+
+def import_video(youtube_id, username, password, mediawiki_url, name='', wiki=None, yt=None):
+    name = file_name(name)
+    result_url = indexed(youtube_id, mediawiki_url)
+    if result_url:
+        print youtube_id, 'was imported already'
+        return result_url
+    if not yt:
+        yt = Youtube()
+    if not wiki:
+        wiki = Mediawiki(mediawiki_url, username, password)
+    store = JobStore(JOB_STORE) if JOB_STORE else None
+    try:
+        return import_job(youtube_id, mediawiki_url, name, wiki, yt, store)
+    finally:
+        yt.forget(youtube_id)
+        if store:
+            store.close()
+
+def import_job(youtube_id, mediawiki_url, name, wiki, yt, store=None):
+    '''
+    Import youtube_id into wiki, continuing where the import recorded in
+    store, a JobStore, stopped.
+    '''
     if MERGE_DASH:
         ffmpeg = ffmpeg_installed()
-    wiki = Mediawiki(mediawiki_url, username, password)
-    info = yt.info(youtube_id)
-    d = tempfile.mkdtemp()
-    filename = os.path.join(d, u"%s.webm" % safe_name(info['title']))
-    description = DESCRIPTION % info
-    result_url = None
+    job = store.get(youtube_id, mediawiki_url) if store else {}
+    def reached(phase):
+        return store and store.reached(job, phase)
+    def record(phase, **fields):
+        if store:
+            job.update(fields, phase=phase)
+            store.update(youtube_id, mediawiki_url, **job)
+    def stashed(filekey, offset):
+        record('stashed', filekey=filekey, offset=offset)
+    if reached('done'):
+        print youtube_id, 'was imported already'
+        return job['result_url']
+    with METRICS.phase('metadata'):
+        info = job['info'] if reached('metadata') else yt.info(youtube_id)
+    streaming = STREAM_UPLOAD and not MERGE_DASH
+    workdir = job.get('workdir') if reached('metadata') else None
+    if not (workdir and os.path.exists(workdir)):
+        workdir = None
+        if reached('downloaded') and not reached('finalized') and not streaming:
+            # downloaded files are gone, start over
+            job.update(phase='metadata', filekey=None, offset=None)
+    if not reached('metadata'):
+        record('metadata', info=info, error=None)
+    fn, comment, description = import_plan(info, name)
+    result_url = job.get('result_url') if reached('finalized') else None
+    if result_url:
+        fn = job['name']
+    resume = (job['filekey'], job['offset']) if job.get('phase') == 'stashed' else None
+    space = None
+    sha1 = job.get('sha1')
+    duplicate = None
+    failed = False
     try:
-        if MERGE_DASH:
+        # check the file and all subtitle pages at once before downloading
+        with METRICS.phase('check'):
+            languages = [] if OVERWRITE else yt.subtitle_languages(youtube_id)
+            pagename = 'File:' + fn.replace(' ', '_')
+            subtitle_names = subtitle_pages(fn, languages)
+            exists = wiki.pages_exist([pagename] + subtitle_names.values())
+        if exists[pagename] and not OVERWRITE and not result_url:
+            raise PermanentError("%s exists, can not upload" % pagename)
+        token = wiki.edit_token()
+        max_size = size_limit([wiki])
+        if result_url or streaming:
+            size = 0
+        elif reached('downloaded'):
+            # the files on disk tell the size, streams still need a merged copy
+            size = directory_size(workdir)
+            if MERGE_DASH and not reached('merged'):
+                size *= 2
+        else:
+            size = workspace_size(yt, youtube_id, max_size)
+        space = WORKSPACE.reserve(size, workdir)
+        d = space.path
+        if d != job.get('workdir'):
+            record(job.get('phase'), workdir=d)
+        filename = os.path.join(d, u"%s.webm" % safe_name(info['title']))
+
+        if result_url:
+            pass
+        elif streaming:
+            def upload_stream(resume):
+                stream, filesize = yt.stream(youtube_id, resume[1] if resume else 0, max_size)
+                try:
+                    return wiki.upload_stream(stream, filesize, comment, description, fn, token,
+                                              resume, stashed)
+                finally:
+                    stream.close()
+            with yt.download_slots:
+                with wiki.upload_slots:
+                    with METRICS.phase('stream'):
+                        try:
+                            result_url = upload_stream(resume)
+                        except StashExpired:
+                            result_url = upload_stream(None)
+        elif MERGE_DASH:
             filename_video = os.path.join(d, "video.dat")
             filename_audio = os.path.join(d, "audio.dat")
-            yt.download(youtube_id, filename_video, filename_audio)
-            if not ( 0 == subprocess.call([ffmpeg, "-i", filename_video, "-i", filename_audio, "-c:v", "copy", "-c:a", "copy", filename], stdout=open(os.devnull, 'wb'), stderr=subprocess.STDOUT) ):
-                raise Exception('merge by ffmpeg failed')
+            if reached('merged'):
+                sha1 = job['sha1']
+            elif STREAM_MERGE and not reached('downloaded'):
+                with yt.download_slots:
+                    with METRICS.phase('download_merge'):
+                        yt.merge(youtube_id, filename, ffmpeg, max_size)
+                space.written(filename)
+                with METRICS.phase('hash'):
+                    sha1 = DEDUPE and sha1sum(filename)
+                record('merged', sha1=sha1)
+            else:
+                if not reached('downloaded'):
+                    with yt.download_slots:
+                        with METRICS.phase('download'):
+                            yt.download(youtube_id, filename_video, filename_audio,
+                                        max_size=max_size)
+                    space.written(filename_video, filename_audio)
+                    record('downloaded')
+                with METRICS.phase('merge'):
+                    check_ffmpeg(*start_ffmpeg(ffmpeg, filename_video, filename_audio, filename))
+                space.written(filename)
+                space.discard(filename_video, filename_audio)
+                with METRICS.phase('hash'):
+                    sha1 = DEDUPE and sha1sum(filename)
+                record('merged', sha1=sha1)
         else:
-            yt.download(youtube_id, filename)
-
-        new_version = 'new version ' if OVERWRITE else ''
-        result_url = wiki.upload(filename, 'Imported %sfrom %s using youtube2mediawiki version %s '%(new_version, info['url'], __version__), description, name)
-        
-        languages = '' if OVERWRITE else yt.subtitle_languages(youtube_id)
-        for lang in languages:
-            srt = yt.subtitles(youtube_id, lang)
-            if srt:
-                subtitle_name = u'TimedText:%s.%s.srt' % (
-                    (name or os.path.basename(filename)).replace(' ', '_'),
-                    lang
-                )
-                r = wiki.edit_page(subtitle_name, srt, 'Imported from %s'%info['url'])
+            if not reached('downloaded'):
+                with yt.download_slots:
+                    with METRICS.phase('download'):
+                        sha1 = yt.download(youtube_id, filename, max_size=max_size)[0]
+                space.written(filename)
+                record('downloaded', sha1=sha1)
+            else:
+                sha1 = job['sha1']
+
+        if not result_url and not resume:
+            duplicate = dedupe(wiki, sha1)
+            if duplicate:
+                # add subtitles to the file already on the wiki instead
+                fn, result_url = duplicate
+                subtitle_names = subtitle_pages(fn, languages)
+                exists = wiki.pages_exist(subtitle_names.values())
+
+        if not result_url:
+            with wiki.upload_slots:
+                with METRICS.phase('upload'):
+                    result_url = wiki.upload(filename, comment, description, fn, token, resume, stashed)
+        if not reached('finalized'):
+            record('finalized', result_url=result_url, name=fn)
+        space.discard(filename)
+
+        with METRICS.phase('subtitles'):
+            missing = [lang for lang in languages if not exists[subtitle_names[lang]]]
+            subtitles = [(lang, srt) for lang, srt in zip(missing, yt.all_subtitles(youtube_id, missing)) if srt]
+            wiki.edit_pages([(subtitle_names[lang], srt) for lang, srt in subtitles],
+                            'Imported from %s'%info['url'])
+        record('done')
+        index_import(youtube_id, mediawiki_url, yt, fn, result_url, sha1,
+                     [lang for lang in languages if lang not in missing] + [lang for lang, srt in subtitles])
+    except PermanentError, e:
+        if not reached('finalized'):
+            failed = True
+            record('failed', workdir=None, filekey=None, offset=None, error=unicode(e))
+        raise
     finally:
-        if result_url:
+        if result_url and not duplicate:
             print 'Uploaded to', result_url
-        shutil.rmtree(d)
+        # with a job store, files are kept until the import is complete
+        if space:
+            space.close(not store or reached('done') or failed)
+    return result_url
+
+def import_async(engine, youtube_id, wiki, yt, name='', slots=None):
+    '''
+    Coroutine importing youtube_id into wiki like import_video, with the
+    blocking calls run on engine, returns the url of the file. It waits for
+    I/O without holding a thread, so that engine can keep many imports going
+    with few threads. slots, a pair of Slots, bound the concurrent downloads
+    and uploads. Unlike import_video, it neither streams nor uses the job
+    store.
+    '''
+    name = file_name(name)
+    downloads, uploads = slots or (Slots(MAX_DOWNLOADS), Slots(MAX_UPLOADS))
+    yt_async, wiki_async = engine.wrap(yt), engine.wrap(wiki)
+    result_url = yield engine.submit(indexed, youtube_id, wiki.url)
+    if result_url:
+        print youtube_id, 'was imported already'
+        raise Return(result_url)
+    with METRICS.phase('metadata'):
+        info = yield yt_async.info(youtube_id)
+    fn, comment, description = import_plan(info, name)
+    # check the file and all subtitle pages at once before downloading
+    with METRICS.phase('check'):
+        languages = [] if OVERWRITE else (yield yt_async.subtitle_languages(youtube_id))
+        pagename = 'File:' + fn.replace(' ', '_')
+        subtitle_names = subtitle_pages(fn, languages)
+        exists = yield wiki_async.pages_exist([pagename] + subtitle_names.values())
+    if exists[pagename] and not OVERWRITE:
+        raise PermanentError("%s exists, can not upload" % pagename)
+    token, max_size, ffmpeg = yield [
+        wiki_async.edit_token(),
+        engine.submit(size_limit, [wiki]),
+        engine.submit(lambda: MERGE_DASH and ffmpeg_installed())
+    ]
+    size = yield engine.submit(workspace_size, yt, youtube_id, max_size)
+    while True:
+        changed = WORKSPACE.changed()
+        space = WORKSPACE.reserve(size, block=False)
+        if space:
+            break
+        yield changed
+    result_url = None
+    duplicate = None
+    try:
+        filename = os.path.join(space.path, u"%s.webm" % safe_name(info['title']))
+        yield downloads.acquire()
+        try:
+            with METRICS.phase('download'):
+                sha1 = yield engine.submit(download_video, yt, youtube_id, filename, ffmpeg, max_size, space)
+        finally:
+            downloads.release()
+        duplicate = yield engine.submit(dedupe, wiki, sha1)
+        if duplicate:
+            # add subtitles to the file already on the wiki instead
+            fn, result_url = duplicate
+            subtitle_names = subtitle_pages(fn, languages)
+            exists = yield wiki_async.pages_exist(subtitle_names.values())
+        else:
+            yield uploads.acquire()
+            try:
+                with METRICS.phase('upload'):
+                    result_url = yield wiki_async.upload(filename, comment, description, fn, token)
+            finally:
+                uploads.release()
+        space.discard(filename)
+        with METRICS.phase('subtitles'):
+            missing = [lang for lang in languages if not exists[subtitle_names[lang]]]
+            subtitles = yield [yt_async.subtitles(youtube_id, lang) for lang in missing]
+            subtitles = [(lang, srt) for lang, srt in zip(missing, subtitles) if srt]
+            yield [wiki_async.edit_page(subtitle_names[lang], srt, 'Imported from %s' % info['url'])
+                   for lang, srt in subtitles]
+        yield engine.submit(index_import, youtube_id, wiki.url, yt, fn, result_url, sha1,
+                            [lang for lang in languages if lang not in missing] + [lang for lang, srt in subtitles])
+    finally:
+        if result_url and not duplicate:
+            print 'Uploaded to', result_url
+        space.close()
+    raise Return(result_url)
+
+def size_limit(wikis):
+    '''
+    Return the largest file size in bytes that all wikis accept and that is
+    within MAX_SIZE, None if there is no limit.
+    '''
+    limits = [int(wiki.siteinfo().get('maxuploadsize') or 0) for wiki in wikis] + [MAX_SIZE]
+    limits = [limit for limit in limits if limit]
+    return min(limits) if limits else None
+
+def download_video(yt, youtube_id, filename, ffmpeg=None, max_size=None, space=None):
+    '''
+    Download youtube_id to filename, with MERGE_DASH by merging its video
+    and audio streams with ffmpeg. Returns the SHA-1 of the file, with
+    MERGE_DASH only if DEDUPE needs it. The best streams of at most max_size
+    bytes in total are chosen. The streams are discarded from the
+    Reservation space once merged.
+    '''
+    if not MERGE_DASH:
+        sha1 = yt.download(youtube_id, filename, max_size=max_size)[0]
+        if space:
+            space.written(filename)
+        return sha1
+    if STREAM_MERGE:
+        yt.merge(youtube_id, filename, ffmpeg, max_size)
+        if space:
+            space.written(filename)
+    else:
+        filename_video = os.path.join(os.path.dirname(filename), "video.dat")
+        filename_audio = os.path.join(os.path.dirname(filename), "audio.dat")
+        yt.download(youtube_id, filename_video, filename_audio, max_size=max_size)
+        if space:
+            space.written(filename_video, filename_audio)
+        check_ffmpeg(*start_ffmpeg(ffmpeg, filename_video, filename_audio, filename))
+        if space:
+            space.written(filename)
+            space.discard(filename_video, filename_audio)
+    return DEDUPE and sha1sum(filename)
+
+def import_fanout(youtube_id, wikis, name='', yt=None):
+    '''
+    Import youtube_id into all of wikis, a list of Mediawiki instances. The
+    video and its subtitles are downloaded once, then uploaded to all wikis
+    concurrently. Returns a dict per wiki, in the order of wikis, with the
+    status of the import and its url or error.
+    '''
+    name = file_name(name)
+    if not yt:
+        yt = Youtube()
+    ffmpeg = ffmpeg_installed() if MERGE_DASH else None
+    results = [{'wiki': wiki.url} for wiki in wikis]
+    def each(function, targets):
+        # call function(i) for the targets i concurrently, recording errors
+        def call(i):
+            with METRICS.job(youtube_id):
+                try:
+                    function(i)
+                except Exception, e:
+                    if DEBUG:
+                        traceback.print_exc()
+                    results[i].update(status='error', error=unicode(e))
+        pmap(call, targets, max(len(targets), 1))
+        return [i for i in targets if 'error' not in results[i]]
+
+    with METRICS.job(youtube_id):
+        with METRICS.phase('metadata'):
+            info = yt.info(youtube_id)
+            languages = [] if OVERWRITE else yt.subtitle_languages(youtube_id)
+    fn, comment, description = import_plan(info, name)
+    pagename = 'File:' + fn.replace(' ', '_')
+
+    def check(i):
+        with METRICS.phase('check'):
+            if wikis[i].pages_exist([pagename])[pagename] and not OVERWRITE:
+                raise PermanentError("%s exists, can not upload" % pagename)
+
+    def publish(i):
+        wiki = wikis[i]
+        # add subtitles to a file already on the wiki instead
+        duplicate = dedupe(wiki, sha1)
+        if duplicate:
+            target, result_url = duplicate
+        else:
+            target = fn
+            with wiki.upload_slots:
+                with METRICS.phase('upload'):
+                    result_url = wiki.upload(filename, comment, description, target, wiki.edit_token())
+            print 'Uploaded to', result_url
+        results[i]['url'] = result_url
+        with METRICS.phase('subtitles'):
+            names = subtitle_pages(target, [lang for lang in languages if subtitles[lang]])
+            exists = wiki.pages_exist(names.values())
+            wiki.edit_pages([(names[lang], subtitles[lang]) for lang in names if not exists[names[lang]]],
+                            'Imported from %s' % info['url'])
+
+    space = None
+    try:
+        targets = each(check, range(len(wikis)))
+        if targets:
+            with METRICS.job(youtube_id):
+                max_size = size_limit([wikis[i] for i in targets])
+                space = WORKSPACE.reserve(workspace_size(yt, youtube_id, max_size))
+                filename = os.path.join(space.path, u"%s.webm" % safe_name(info['title']))
+                with yt.download_slots:
+                    with METRICS.phase('download'):
+                        sha1 = download_video(yt, youtube_id, filename, ffmpeg, max_size, space)
+                with METRICS.phase('fetch_subtitles'):
+                    subtitles = dict(zip(languages, yt.all_subtitles(youtube_id, languages)))
+            each(publish, targets)
+    finally:
+        yt.forget(youtube_id)
+        if space:
+            space.close()
+    for result in results:
+        result.setdefault('status', 'ok')
+        METRICS.count('imports', status=result['status'])
+    return results
+
+def load_targets(filename):
+    '''
+    Log in to the wikis listed in the JSON file filename, a list of objects
+    with url, username and password, returns them as Mediawiki instances.
+    The password defaults to the Y2M_PASSWORD environment variable.
+    '''
+    with open(filename) as f:
+        targets = json.load(f)
+    return pmap(lambda target: Mediawiki(target['url'], target['username'],
+                                         target.get('password') or os.environ.get('Y2M_PASSWORD')),
+                targets, len(targets))
+
+def import_batch(lines, username, password, mediawiki_url, results, jobs=4, wikis=None, wiki=None, yt=None):
+    '''
+    Import several videos concurrently, sharing one wiki session.
+
+    lines contains a YouTube id or url per line, optionally followed by a tab
+    and the name of the file on the wiki. A playlist or channel url stands
+    for all its videos, imported with their titles as names. The listing is
+    expanded while the imports run and the metadata of the next PREFETCH
+    videos is fetched ahead of them. Videos that INDEX has for the wiki are
+    reported with their url right away.
+
+    The outcome of every import is written as a line of JSON to the file
+    object results. With wikis, a list of Mediawiki instances, every video is
+    imported into all of them with import_fanout and there is a line for
+    each wiki. wiki and yt are the sessions to use, if already open.
+    '''
+    yt = yt or Youtube()
+    if not wikis and not wiki:
+        wiki = Mediawiki(mediawiki_url, username, password)
+    lock = threading.Lock()
+    def report(outcomes, **fields):
+        with lock:
+            for outcome in outcomes:
+                result = dict(fields)
+                result.update(outcome)
+                results.write(json.dumps(result) + '\n')
+            results.flush()
+    imported = {}
+    if INDEX and not OVERWRITE and not wikis:
+        with closing(ImportIndex(INDEX)) as index:
+            imported = index.videos(mediawiki_url)
+    def entries():
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '\t' in line:
+                url, name = line.split('\t', 1)
+            else:
+                url, name = line, ''
+            url, name = url.strip(), name.strip()
+            feed = parse_list(url)
+            if not feed:
+                yield parse_id(url), name
+                continue
+            try:
+                for youtube_id in yt.playlist(feed):
+                    yield youtube_id, ''
+            except Exception, e:
+                if DEBUG:
+                    traceback.print_exc()
+                report([{'status': 'error', 'error': unicode(e)}], id=url, name=name)
+    def pending(entries):
+        # skip indexed videos before their metadata is prefetched
+        for youtube_id, name in entries:
+            if youtube_id in imported:
+                print youtube_id, 'was imported already'
+                report([{'url': imported[youtube_id]['url'], 'status': 'ok'}], id=youtube_id, name=name)
+            else:
+                yield youtube_id, name
+    entries = prefetch(lambda entry: yt.preload(entry[0]), pending(entries()), PREFETCH)
+    if IO_THREADS and not wikis:
+        return import_batch_async(entries, wiki, yt, report, jobs)
+    queue = Queue.Queue(jobs)
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            youtube_id, name = item
+            try:
+                if wikis:
+                    outcomes = import_fanout(youtube_id, wikis, name, yt)
+                else:
+                    url = import_youtube(youtube_id, username, password, mediawiki_url, name, wiki, yt)
+                    outcomes = [{'url': url, 'status': 'ok'}]
+            except Exception, e:
+                if DEBUG:
+                    traceback.print_exc()
+                if wikis:
+                    outcomes = [{'wiki': w.url, 'status': 'error', 'error': unicode(e)} for w in wikis]
+                else:
+                    outcomes = [{'status': 'error', 'error': unicode(e)}]
+            report(outcomes, id=youtube_id, name=name)
+    workers = [threading.Thread(target=worker) for i in range(jobs)]
+    for t in workers:
+        t.start()
+    try:
+        for entry in entries:
+            queue.put(entry)
+    finally:
+        for t in workers:
+            queue.put(None)
+        for t in workers:
+            t.join()
+
+def import_batch_async(entries, wiki, yt, report, jobs):
+    '''
+    Run up to jobs imports of the (youtube_id, name) pairs in entries at once
+    with import_async, on an Engine of IO_THREADS threads. The outcomes are
+    passed to report like in import_batch.
+    '''
+    engine = Engine(IO_THREADS)
+    slots = (Slots(MAX_DOWNLOADS), Slots(MAX_UPLOADS))
+    active = Slots(jobs)
+    def finished(future, youtube_id, name, started):
+        try:
+            with METRICS.job(youtube_id):
+                if future.error:
+                    e = future.error[1]
+                    if DEBUG:
+                        traceback.print_exception(*future.error)
+                    METRICS.count('imports', status='error')
+                    METRICS.event('import', status='error', error=unicode(e), seconds=time.time() - started)
+                    outcome = {'status': 'error', 'error': unicode(e)}
+                else:
+                    METRICS.count('imports', status='ok')
+                    METRICS.event('import', status='ok', url=future.value, seconds=time.time() - started)
+                    outcome = {'url': future.value, 'status': 'ok'}
+            METRICS.write()
+            report([outcome], id=youtube_id, name=name)
+        finally:
+            yt.forget(youtube_id)
+            active.release()
+    try:
+        for youtube_id, name in entries:
+            active.acquire().result()
+            with METRICS.job(youtube_id):
+                future = engine.spawn(import_async(engine, youtube_id, wiki, yt, name, slots))
+            future.add_done_callback(lambda future, youtube_id=youtube_id, name=name, started=time.time():
+                                     finished(future, youtube_id, name, started))
+    finally:
+        # wait for the running imports
+        for i in range(jobs):
+            active.acquire().result()
+
+def sync_captions(youtube_id, video, wiki, yt):
+    '''
+    Import the caption languages of youtube_id that were added since video,
+    its record in INDEX, was written. Returns the languages imported.
+    '''
+    languages = [lang for lang in yt.subtitle_languages(youtube_id) if lang not in video['languages']]
+    names = dict((lang, u'TimedText:%s.%s.srt' % (video['name'].replace(' ', '_'), lang))
+                 for lang in languages)
+    exists = wiki.pages_exist(names.values()) if names else {}
+    missing = [lang for lang in languages if not exists[names[lang]]]
+    subtitles = [(lang, srt) for lang, srt in zip(missing, yt.all_subtitles(youtube_id, missing)) if srt]
+    wiki.edit_pages([(names[lang], srt) for lang, srt in subtitles],
+                    'Imported from %s/watch?v=%s' % (YOUTUBE_URL, youtube_id))
+    imported = [lang for lang in languages if lang not in missing] + [lang for lang, srt in subtitles]
+    with closing(ImportIndex(INDEX)) as index:
+        index.update(youtube_id, wiki.url, languages=video['languages'] + imported,
+                     updated=yt.listed.get(youtube_id))
+    return imported
+
+def sync(feed, username, password, mediawiki_url, results, jobs=4):
+    '''
+    Bring the wiki up to date with the gdata feed feed of a playlist or
+    channel, by its record of earlier imports in INDEX. The listing is
+    compared with INDEX in one pass: new videos are imported with
+    import_batch, indexed videos whose entry was updated since are checked
+    for new caption languages, the others cost no request at all. The wiki
+    is only logged in to if there is something to do.
+
+    Outcomes are written to results like by import_batch, with the
+    imported languages as captions for the caption updates.
+    '''
+    yt = Youtube()
+    with closing(ImportIndex(INDEX)) as index:
+        known = index.videos(mediawiki_url)
+    listed = list(yt.playlist(feed))
+    new = [youtube_id for youtube_id in listed if youtube_id not in known]
+    updated = [youtube_id for youtube_id in listed if youtube_id in known and
+               yt.listed[youtube_id] and yt.listed[youtube_id] != known[youtube_id]['updated']]
+    print '%d videos listed, %d new, %d updated' % (len(listed), len(new), len(updated))
+    if not (new or updated):
+        return
+    wiki = Mediawiki(mediawiki_url, username, password)
+    lock = threading.Lock()
+    def check(youtube_id):
+        video = known[youtube_id]
+        try:
+            outcome = {'url': video['url'], 'status': 'ok', 'captions': sync_captions(youtube_id, video, wiki, yt)}
+        except Exception, e:
+            if DEBUG:
+                traceback.print_exc()
+            outcome = {'status': 'error', 'error': unicode(e)}
+        outcome.update(id=youtube_id, name=video['name'])
+        with lock:
+            results.write(json.dumps(outcome) + '\n')
+            results.flush()
+    pmap(check, updated, jobs)
+    if new:
+        import_batch(new, username, password, mediawiki_url, results, jobs, wiki=wiki, yt=yt)
+
+class ImportDaemon(object):
+    '''
+    Runs submitted imports with up to jobs workers, sharing one YouTube
+    opener and one wiki session, and keeps the status of every job until
+    HISTORY later jobs have finished.
+
+    A job may set overwrite and dash, which switch OVERWRITE (with
+    IGNORE_WARNINGS) and MERGE_DASH. As these are global, a job only starts
+    while no job with other options is running. Jobs start in the order they
+    were submitted.
+    '''
+    HISTORY = 1000
+
+    def __init__(self, username, password, mediawiki_url, jobs=4):
+        self.username = username
+        self.password = password
+        self.mediawiki_url = mediawiki_url
+        self.yt = Youtube()
+        self.wiki = Mediawiki(mediawiki_url, username, password)
+        self.defaults = {'overwrite': OVERWRITE, 'dash': MERGE_DASH}
+        self.ignore_warnings = IGNORE_WARNINGS
+        self.jobs = {}
+        self.submitted = 0
+        self.finished = collections.deque()
+        self.pending = []
+        self.running = 0
+        self.options = None
+        self.condition = threading.Condition()
+        for i in range(jobs):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, youtube_id, name='', overwrite=None, dash=None):
+        """Queue the import of youtube_id, returns the status of the new job."""
+        options = dict(self.defaults)
+        if overwrite is not None:
+            options['overwrite'] = bool(overwrite)
+        if dash is not None:
+            options['dash'] = bool(dash)
+        with self.condition:
+            self.submitted += 1
+            job = {
+                'job': str(self.submitted),
+                'id': youtube_id,
+                'name': name,
+                'options': options,
+                'status': 'queued',
+                'submitted': time.time()
+            }
+            self.jobs[job['job']] = job
+            self.pending.append(job)
+            self.condition.notify_all()
+            return dict(job)
+
+    def status(self, job=None):
+        """Return the status of job, or of all jobs."""
+        with self.condition:
+            if job is None:
+                return [dict(self.jobs[key]) for key in sorted(self.jobs, key=int)]
+            return dict(self.jobs[job]) if job in self.jobs else None
+
+    def next_job(self):
+        global OVERWRITE, IGNORE_WARNINGS, MERGE_DASH
+        with self.condition:
+            while not self.pending or \
+                (self.running and self.pending[0]['options'] != self.options):
+                self.condition.wait()
+            job = self.pending.pop(0)
+            if not self.running:
+                self.options = job['options']
+                OVERWRITE = self.options['overwrite']
+                IGNORE_WARNINGS = self.ignore_warnings or OVERWRITE
+                MERGE_DASH = self.options['dash']
+            self.running += 1
+            job.update(status='running', started=time.time())
+            return job
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            result = {}
+            try:
+                result['url'] = import_youtube(job['id'], self.username, self.password,
+                                               self.mediawiki_url, job['name'], self.wiki, self.yt)
+                result['status'] = 'done'
+            except Exception, e:
+                if DEBUG:
+                    traceback.print_exc()
+                result['status'] = 'error'
+                result['error'] = unicode(e)
+            with self.condition:
+                job.update(result, finished=time.time())
+                self.finished.append(job['job'])
+                while len(self.finished) > self.HISTORY:
+                    del self.jobs[self.finished.popleft()]
+                self.running -= 1
+                self.condition.notify_all()
+
+class DaemonHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    JSON API of ImportDaemon:
+
+        POST /jobs      {"id": id or url, "name": name, "overwrite": bool, "dash": bool}
+        GET /jobs       status of all jobs
+        GET /jobs/N     status of job N
+    '''
+    def log_message(self, format, *args):
+        if DEBUG:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def respond(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        if path == '/jobs':
+            return self.respond(200, self.server.importer.status())
+        if path.startswith('/jobs/'):
+            job = self.server.importer.status(path[6:])
+            if job:
+                return self.respond(200, job)
+        self.respond(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.respond(404, {'error': 'not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+            youtube_id = parse_id(request['id'].strip())
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self.respond(400, {'error': 'expected a JSON object with an id'})
+        job = self.server.importer.submit(youtube_id, request.get('name') or '',
+                                        request.get('overwrite'), request.get('dash'))
+        self.respond(202, job)
+
+class DaemonServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def run_daemon(address, username, password, mediawiki_url, jobs=4):
+    '''Serve the job API of an ImportDaemon on address, [host:]port, until interrupted.'''
+    host, port = address.rsplit(':', 1) if ':' in address else ('127.0.0.1', address)
+    server = DaemonServer((host, int(port)), DaemonHandler)
+    server.importer = ImportDaemon(username, password, mediawiki_url, jobs)
+    print 'Accepting jobs at http://%s:%d/jobs' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
 
 def parse_id(url):
     match = re.compile('\?v=([^&]+)').findall(url)
@@ -593,11 +3429,23 @@ def parse_id(url):
         return match[0]
     return url
 
+def parse_list(url):
+    '''
+    Return the path of the gdata feed listing the videos of a playlist or
+    channel url, None for other urls.
+    '''
+    match = re.compile('youtube\.com/(?:user|channel)/([^/?&#]+)').search(url)
+    if match:
+        return '/feeds/api/users/%s/uploads' % match.group(1)
+    match = re.compile('youtube\.com/playlist\?(?:.*&)?list=([^&#]+)').search(url)
+    if match:
+        return '/feeds/api/playlists/%s' % match.group(1)
+    return None
+
 if __name__ == "__main__":
     from optparse import OptionParser
-    import sys
 
-    usage = "Usage: %prog [options] youtubeid"
+    usage = "Usage: %prog [options] youtubeid|playlist|channel\n       %prog [options] --batch FILE\n       %prog [options] --daemon [HOST:]PORT\n       %prog [options] --index FILE --sync playlist|channel"
     parser = OptionParser(usage=usage)
     parser.add_option('-u', '--username', dest='username', help='wiki username', type='string')
     parser.add_option('-p', '--password', dest='password', help='wiki password\n(can also be provided via Y2M_PASSWORD environment variable)', type='string')
@@ -607,25 +3455,105 @@ if __name__ == "__main__":
     parser.add_option('-d', '--debug', dest='debug', help='output debug information', action="store_true")
     parser.add_option('-i', '--ignore-warnings', dest='ignorewarnings', help='ignore warnings during upload', action="store_true")
     parser.add_option('-a', '--adaptive-streaming', dest='vp9', help='fetch HD VP9 stream + audio stream and merge both using ffmpeg', action="store_true")
+    parser.add_option('-P', '--pipeline', dest='pipeline', help='read ahead upload chunks while uploading and let the wiki assemble the file asynchronously', action="store_true")
+    parser.add_option('-s', '--stream', dest='stream', help='upload while downloading, without a temporary file (not with --adaptive-streaming)', action="store_true")
     parser.add_option('-o', '--overwrite', dest='overwrite', help='force overwriting files at the destination wiki (requires --ignore-warnings)', action="store_true")
+    parser.add_option('-c', '--cache', dest='cache', help='keep YouTube metadata in DIR for an hour, to be reused by reruns', type='string')
+    parser.add_option('--session-cache', dest='session_cache', help='keep wiki session cookies and tokens in DIR and reuse them instead of logging in', type='string')
+    parser.add_option('--edit-threads', dest='edit_threads', help='number of concurrent subtitle page edits [default:4]', type='int', default=4)
+    parser.add_option('--no-dedupe', dest='dedupe', help='upload even if a file with the same SHA-1 is on the wiki already', action="store_false", default=True)
+    parser.add_option('--job-store', dest='job_store', help='record the progress of imports in the SQLite database FILE and resume interrupted imports', type='string')
+    parser.add_option('--workspace', dest='workspace', help='comma separated directories for temporary files, the first with enough space is used, e.g. a tmpfs and then a disk [default:%s]' % tempfile.gettempdir(), type='string')
+    parser.add_option('--workspace-budget', dest='workspace_budget', help='maximum MB of temporary files of all imports, further imports wait until enough is free', type='int')
+    parser.add_option('--index', dest='index', help='record imported videos in the SQLite database FILE and skip them in later imports', type='string')
+    parser.add_option('--sync', dest='sync', help='import only the videos of a playlist or channel that are not in --index yet and caption languages added since', action="store_true")
+    parser.add_option('--max-connections', dest='max_connections', help='number of connections kept open per host [default:8]', type='int', default=8)
+    parser.add_option('--chunk-size', dest='chunk_size', help='size of the first upload chunk in MB, later chunks are sized by the measured throughput [default:5]', type='int', default=5)
+    parser.add_option('--fixed-chunks', dest='adaptive_chunks', help='upload all chunks with --chunk-size', action="store_false", default=True)
+    parser.add_option('--api-rate', dest='api_rate', help='maximum number of API requests per second to the wiki, shared by all imports on this host [default:50]', type='float', default=50)
+    parser.add_option('--maxlag', dest='maxlag', help='wait while the replication lag of the wiki is above MAXLAG seconds, 0 to disable [default:5]', type='int', default=5)
+    parser.add_option('--max-size', dest='max_size', help='download the best version of at most MAX_SIZE MB, smaller ones if the wiki accepts less', type='int')
+    parser.add_option('--metrics', dest='metrics', help='write timings, request counts and retries to FILE', type='string')
+    parser.add_option('--metrics-format', dest='metrics_format', help='format of the metrics FILE: json (lines) or prometheus [default:json]',
+                      type='choice', choices=['json', 'prometheus'], default='json')
+    parser.add_option('-b', '--batch', dest='batch', help='import all YouTube ids or urls listed in FILE, one per line (- for stdin)', type='string')
+    parser.add_option('-t', '--targets', dest='targets', help='import into all wikis listed in the JSON file FILE, a list of objects with url, username and password, downloading each video once', type='string')
+    parser.add_option('--daemon', dest='daemon', help='run imports submitted to a JSON API on [HOST:]PORT, by default on localhost', type='string')
+    parser.add_option('--prefetch', dest='prefetch', help='number of videos whose metadata is fetched ahead of their import in batch mode [default:%d]' % PREFETCH,
+                      type='int', default=PREFETCH)
+    parser.add_option('-j', '--jobs', dest='jobs', help='number of concurrent imports in batch and daemon mode [default:4]', type='int', default=4)
+    parser.add_option('--io-threads', dest='io_threads', help='run batch imports as coroutines on IO_THREADS threads, so that --jobs can be in the hundreds (not with --stream, --job-store or --targets)', type='int')
+    parser.add_option('--max-downloads', dest='max_downloads', help='number of concurrent downloads in batch and daemon mode [default:2]', type='int', default=2)
+    parser.add_option('--max-uploads', dest='max_uploads', help='number of concurrent uploads in batch and daemon mode [default:2]', type='int', default=2)
+    parser.add_option('-r', '--results', dest='results', help='write the result of each batch or multi-wiki import to FILE as JSON lines [default: stdout]', type='string')
     (opts, args) = parser.parse_args()
     if not opts.password:
         opts.password = os.environ.get('Y2M_PASSWORD')
 
-    if None in (opts.username, opts.password) or not args:
+    if (None in (opts.username, opts.password) and not opts.targets) or \
+        not (args or opts.batch or opts.daemon):
         parser.print_help()
         sys.exit(-1)
+    if opts.io_threads and (opts.stream or opts.job_store or opts.targets):
+        parser.error('--io-threads can not be combined with --stream, --job-store or --targets')
+    if opts.daemon and opts.targets:
+        parser.error('--targets can not be combined with --daemon')
+    if opts.sync and (not opts.index or opts.targets or opts.batch or not (args and parse_list(args[0]))):
+        parser.error('--sync needs --index and a playlist or channel url, not --targets or --batch')
 
     DEBUG = opts.debug
     IGNORE_WARNINGS = opts.ignorewarnings
     MERGE_DASH = opts.vp9
     OVERWRITE = opts.overwrite
-    youtube_id = parse_id(args[0])
+    PIPELINE_UPLOAD = opts.pipeline
+    STREAM_UPLOAD = opts.stream
+    MAX_DOWNLOADS = opts.max_downloads
+    MAX_UPLOADS = opts.max_uploads
+    CACHE_DIR = opts.cache
+    SESSION_CACHE = opts.session_cache
+    EDIT_THREADS = opts.edit_threads
+    DEDUPE = opts.dedupe
+    JOB_STORE = opts.job_store
+    INDEX = opts.index
+    MAX_CONNECTIONS = opts.max_connections
+    CHUNKSIZE = opts.chunk_size * 1024 * 1024
+    ADAPTIVE_CHUNKS = opts.adaptive_chunks
+    API_RATE = opts.api_rate
+    MAXLAG = opts.maxlag
+    MAX_SIZE = opts.max_size and opts.max_size * 1024 * 1024
+    PREFETCH = opts.prefetch
+    IO_THREADS = opts.io_threads
+    WORKSPACE = Workspace(opts.workspace and [os.path.abspath(d) for d in opts.workspace.split(',')],
+                          opts.workspace_budget and opts.workspace_budget * 1024 * 1024)
+    if opts.metrics:
+        METRICS.open(opts.metrics, opts.metrics_format)
     try:
-        import_youtube(youtube_id, opts.username, opts.password, opts.url, opts.name)
+        if opts.sync:
+            results = open(opts.results, 'a') if opts.results else sys.stdout
+            sync(parse_list(args[0]), opts.username, opts.password, opts.url, results, opts.jobs)
+        elif opts.daemon:
+            run_daemon(opts.daemon, opts.username, opts.password, opts.url, opts.jobs)
+        elif opts.batch or parse_list(args[0]):
+            if opts.batch:
+                lines = sys.stdin if opts.batch == '-' else open(opts.batch)
+            else:
+                lines = args
+            results = open(opts.results, 'a') if opts.results else sys.stdout
+            wikis = load_targets(opts.targets) if opts.targets else None
+            import_batch(lines, opts.username, opts.password, opts.url, results, opts.jobs, wikis)
+        elif opts.targets:
+            youtube_id = parse_id(args[0])
+            results = open(opts.results, 'a') if opts.results else sys.stdout
+            for result in import_fanout(youtube_id, load_targets(opts.targets), opts.name):
+                results.write(json.dumps(result) + '\n')
+        else:
+            youtube_id = parse_id(args[0])
+            import_youtube(youtube_id, opts.username, opts.password, opts.url, opts.name)
     except Exception as e:
         if not DEBUG:
             print e
             print "Exception caught! Consider using the --debug option to identify the issue."
         else:
             traceback.print_exc()
+    finally:
+        METRICS.close()